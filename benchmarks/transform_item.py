@@ -0,0 +1,54 @@
+import os
+import sys
+import gzip
+import json
+import types
+import timeit
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from workflows.crossref import CrossrefSnapshot
+
+
+# Micro-benchmark of CrossrefSnapshot.transform_item on the Crossref test fixture, optionally
+# against the transform_item of another revision, e.g.
+#
+#   python benchmarks/transform_item.py --baseline c94d409
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'test_files_crossref', 'crossref_sample.json.gz')
+
+
+def load_revision(revision: str):
+    source = subprocess.run(['git', 'show', f'{revision}:workflows/crossref.py'],
+                            stdout=subprocess.PIPE, check=True, text=True).stdout
+    module = types.ModuleType(f'crossref_{revision}')
+    exec(compile(source, module.__name__, 'exec'), module.__dict__)
+    return module.CrossrefSnapshot.transform_item
+
+
+def records_per_second(transform_item, items: list, repeat: int) -> float:
+    seconds = min(timeit.repeat(lambda: [transform_item(item) for item in items], number=1, repeat=repeat))
+    return len(items) / seconds
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--baseline', help='git revision to compare with')
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with gzip.open(FIXTURE, mode='r') as file:
+        items = json.load(file)['items']
+
+    items = (items * (args.records // len(items) + 1))[:args.records]
+
+    candidates = {'current': CrossrefSnapshot.transform_item}
+    if args.baseline:
+        candidates[args.baseline] = load_revision(args.baseline)
+
+    for name, transform_item in candidates.items():
+        print(f'{name:>12} {records_per_second(transform_item, items, args.repeat):10,.0f} records/s')
@@ -0,0 +1,232 @@
+import sys
+import json
+import time
+import sqlite3
+import logging
+import importlib
+import threading
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable
+
+
+# states of a task within a run; only succeeded tasks are skipped when a run is resumed
+SUCCESS = 'success'
+FAILED = 'failed'
+UPSTREAM_FAILED = 'upstream_failed'
+
+
+class NonRetryableError(Exception):
+    # raised by a task that can not succeed by running it again, it fails without further retries
+    pass
+
+
+@dataclass
+class Task:
+    name: str
+    func: Callable
+    deps: list[str] = field(default_factory=list)
+    retries: int = 0
+    retry_delay: float = 60
+
+
+class DAG:
+
+    def __init__(self, name: str, run_id: str):
+
+        # run_id identifies the run whose state is resumed, e.g. the snapshot month
+        self.name = name
+        self.run_id = run_id
+        self.tasks = {}
+
+    def task(self, deps: list[str] = (), retries: int = 0, retry_delay: float = 60):
+        # decorator; the task is called with the results of its dependencies as keyword arguments
+        def decorator(func):
+            self.add_task(Task(func.__name__, func, list(deps), retries, retry_delay))
+            return func
+
+        return decorator
+
+    def add_task(self, task: Task) -> None:
+        if task.name in self.tasks:
+            raise ValueError(f'Task {task.name} is already part of DAG {self.name}.')
+
+        for dep in task.deps:
+            if dep not in self.tasks:
+                raise ValueError(f'Task {task.name} depends on unknown task {dep}.')
+
+        # dependencies have to be added first, so the DAG cannot contain cycles
+        self.tasks[task.name] = task
+
+    def downstream(self, names: list[str]) -> list[str]:
+        # the given tasks and all tasks depending on them
+        names = set(names)
+        for task in self.tasks.values():
+            if names.intersection(task.deps):
+                names.add(task.name)
+        return [name for name in self.tasks if name in names]
+
+
+class StateStore:
+
+    # task states and JSON results of all runs, kept in a local SQLite file
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS task_runs ('
+                                    'dag TEXT NOT NULL, '
+                                    'run_id TEXT NOT NULL, '
+                                    'task TEXT NOT NULL, '
+                                    'state TEXT NOT NULL, '
+                                    'attempts INTEGER NOT NULL, '
+                                    'result TEXT, '
+                                    'error TEXT, '
+                                    'updated REAL NOT NULL, '
+                                    'PRIMARY KEY (dag, run_id, task))')
+
+    def load(self, dag: DAG) -> dict[str, tuple]:
+        with self.lock:
+            rows = self.connection.execute('SELECT task, state, attempts, result FROM task_runs '
+                                           'WHERE dag = ? AND run_id = ?', (dag.name, dag.run_id)).fetchall()
+
+        return {task: (state, attempts, json.loads(result) if result is not None else None)
+                for task, state, attempts, result in rows}
+
+    def save(self, dag: DAG, task: str, state: str, attempts: int, result=None, error: str = None) -> None:
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO task_runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (dag.name,
+                                     dag.run_id,
+                                     task,
+                                     state,
+                                     attempts,
+                                     json.dumps(result) if result is not None else None,
+                                     error,
+                                     time.time()))
+
+    def reset(self, dag: DAG, tasks: list[str]) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM task_runs WHERE dag = ? AND run_id = ? AND task = ?',
+                                        [(dag.name, dag.run_id, task) for task in tasks])
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def run_task(task: Task, kwargs: dict, delay: float):
+    if delay:
+        time.sleep(delay)
+    return task.func(**kwargs)
+
+
+def run_dags(dags: list[DAG],
+             state_path: str,
+             max_workers: int = 4,
+             reset: list[str] = ()) -> dict[str, dict[str, str]]:
+
+    # Runs the tasks of all DAGs in one thread pool, so independent tasks (also of different
+    # DAGs) overlap. A failed task is retried up to task.retries times unless it raised a
+    # NonRetryableError; once it failed for good, its downstream tasks are skipped while the
+    # rest keeps running. Succeeded tasks and
+    # their results are persisted in state_path, and a rerun with the same run ids skips them.
+    # reset, e.g. ['crossref.transform'], reruns the given tasks and everything downstream.
+    store = StateStore(state_path)
+
+    names = [dag.name for dag in dags]
+    if len(set(names)) != len(names):
+        raise ValueError(f'DAG names {names} are not unique.')
+
+    for dag in dags:
+        tasks = [name.partition('.')[2] for name in reset if name.partition('.')[0] == dag.name]
+        store.reset(dag, dag.downstream(tasks))
+
+    states = {}
+    results = {}
+    attempts = {}
+
+    for dag in dags:
+        for task, (state, _, result) in store.load(dag).items():
+            if task in dag.tasks and state == SUCCESS:
+                states[(dag.name, task)] = SUCCESS
+                results[(dag.name, task)] = result
+                logging.info(f'Task {dag.name}.{task} already succeeded in run {dag.run_id}, skipping it.')
+
+    tasks = {(dag.name, task.name): (dag, task) for dag in dags for task in dag.tasks.values()}
+    running = {}
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+            def submit(key: tuple, delay: float = 0):
+                dag, task = tasks[key]
+                kwargs = {dep: results[(dag.name, dep)] for dep in task.deps}
+                attempts[key] = attempts.get(key, 0) + 1
+                logging.info(f'Running task {dag.name}.{task.name} (attempt {attempts[key]}).')
+                running[executor.submit(run_task, task, kwargs, delay)] = key
+
+            while True:
+                for key, (dag, task) in tasks.items():
+                    if key in states or key in running.values():
+                        continue
+
+                    dep_states = [states.get((dag.name, dep)) for dep in task.deps]
+                    if any(state in (FAILED, UPSTREAM_FAILED) for state in dep_states):
+                        states[key] = UPSTREAM_FAILED
+                        store.save(dag, task.name, UPSTREAM_FAILED, 0)
+                        logging.warning(f'Skipping task {dag.name}.{task.name}, an upstream task failed.')
+                    elif all(state == SUCCESS for state in dep_states):
+                        submit(key)
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    key = running.pop(future)
+                    dag, task = tasks[key]
+
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        if attempts[key] <= task.retries and not isinstance(e, NonRetryableError):
+                            logging.warning(f'Task {dag.name}.{task.name} failed ({e!r}), retrying in {task.retry_delay} seconds.')
+                            submit(key, task.retry_delay)
+                        else:
+                            logging.exception(f'Task {dag.name}.{task.name} failed after {attempts[key]} attempts.')
+                            states[key] = FAILED
+                            store.save(dag, task.name, FAILED, attempts[key], error=repr(e))
+                        continue
+
+                    states[key] = SUCCESS
+                    results[key] = result
+                    store.save(dag, task.name, SUCCESS, attempts[key], result)
+                    logging.info(f'Task {dag.name}.{task.name} succeeded.')
+    finally:
+        store.close()
+
+    return {dag.name: {task: states[(dag.name, task)] for task in dag.tasks} for dag in dags}
+
+
+if __name__ == '__main__':
+
+    # e.g. python dag_runner.py dags.crossref_dag dags.document_types_dag [--reset crossref.transform]
+    args = sys.argv[1:]
+    reset = []
+    while '--reset' in args:
+        index = args.index('--reset')
+        reset.append(args[index + 1])
+        del args[index:index + 2]
+
+    # the DAG modules configure logging and share the state file of the first one
+    modules = [importlib.import_module(name) for name in args]
+
+    dag_states = run_dags([module.build_dag() for module in modules],
+                          state_path=modules[0].STATE_PATH,
+                          reset=reset)
+
+    if any(state != SUCCESS for states in dag_states.values() for state in states.values()):
+        sys.exit(1)
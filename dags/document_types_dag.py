@@ -1,12 +1,21 @@
 import pickle
-import time
 import os
+import shutil
+import datetime
 import logging
 from pathlib import Path
 from dotenv import load_dotenv
-from bq_utils import upload_files_to_bucket, create_table_from_bucket, delete_files_from_bucket
+from bq_utils import (PipelinedUploader,
+                      StorageWriteSink,
+                      copy_table_in_bq,
+                      create_empty_table,
+                      create_table_from_bucket,
+                      delete_files_from_bucket,
+                      drop_table_in_bq)
 from workflows.document_types import OpenAlexDocumentTypesSnapshot
-from scheduler import execute_slurm_file, get_job_status
+from workflows.utils import MANIFEST_NAME, Manifest, follow_manifests, read_streams
+from scheduler import ACTIVE_STATES, execute_slurm_file, array_range, cancel_jobs, get_job_status, wait_for_jobs
+from dag_runner import DAG, NonRetryableError, run_dags
 
 
 dotenv_path = Path('~/.env')
@@ -14,74 +23,219 @@ load_dotenv(dotenv_path=dotenv_path)
 ETL_URL = os.environ['ETL_URL']
 LOG_URL = os.environ['LOG_URL']
 MAIL_USER = os.environ['MAIL_USER']
+ARRAY_SIZE = int(os.environ.get('TRANSFORM_ARRAY_SIZE', 8))
 MODEL_URL = os.environ['MODEL_URL']
+STATE_PATH = os.environ.get('DAG_STATE_PATH', f'{ETL_URL}/dag_state.sqlite')
+# STORAGE_WRITE_API=1 streams the records into BigQuery from the transform workers, which skips
+# the upload to, load from and cleanup of the Google Bucket
+STORAGE_WRITE_API = os.environ.get('STORAGE_WRITE_API', '0') == '1'
+# seconds the upload follows the transform jobs, while they are queued and running
+UPLOAD_TIMEOUT = float(os.environ.get('UPLOAD_TIMEOUT', 2 * 24 * 60 * 60))
 
 
 logging.basicConfig(filename=f'{LOG_URL}/scheduler.log', encoding='utf-8', level=logging.DEBUG)
 
 
-logging.info('Creating Snapshot object.')
-document_type_snapshot = OpenAlexDocumentTypesSnapshot(
-                                              model_path=f'{MODEL_URL}',
-                                              download_path=f'{ETL_URL}/download_document_types',
-                                              transform_path=f'{ETL_URL}/transform_document_types')
+# the workers write into pending streams of this table, which is copied to document_types_snapshot once committed
+PENDING_TABLE_ID = 'document_types_snapshot_pending'
+
+
+def storage_write_sink() -> StorageWriteSink:
+    return StorageWriteSink(project_id='subugoe-wag-closed',
+                            dataset_id='oal_doctypes',
+                            table_id=PENDING_TABLE_ID,
+                            schema_file_path=OpenAlexDocumentTypesSnapshot.SCHEMA_FILE_PATH)
+
+
+def build_dag(run_id: str = None) -> DAG:
+
+    # one run per month, a rerun within the month resumes after the last succeeded task
+    dag = DAG('document_types', run_id or os.environ.get('DAG_RUN_ID', f'{datetime.date.today():%Y-%m}'))
+
+    @dag.task()
+    def snapshot():
+        logging.info('Creating Snapshot object.')
+        # OpenAlex snapshots have no date of their own, the outputs of the month are kept
+        # for resuming and are replaced in the next month
+        today = datetime.date.today()
+        if STORAGE_WRITE_API:
+            # streams can only be created for an existing table; outputs of an earlier run list
+            # streams of the table it replaces, so they are transformed again
+            shutil.rmtree(f'{ETL_URL}/transform_document_types', ignore_errors=True)
+            create_empty_table(table_id=PENDING_TABLE_ID,
+                               project_id='subugoe-wag-closed',
+                               dataset_id='oal_doctypes',
+                               schema_file_path=OpenAlexDocumentTypesSnapshot.SCHEMA_FILE_PATH)
+
+            document_type_snapshot = OpenAlexDocumentTypesSnapshot(
+                                                      model_path=f'{MODEL_URL}',
+                                                      download_path=f'{ETL_URL}/download_document_types',
+                                                      transform_path=f'{ETL_URL}/transform_document_types',
+                                                      snapshot_date=[today.year, today.month],
+                                                      output_format='storage_write',
+                                                      sink=storage_write_sink())
+        else:
+            document_type_snapshot = OpenAlexDocumentTypesSnapshot(
+                                                      model_path=f'{MODEL_URL}',
+                                                      download_path=f'{ETL_URL}/download_document_types',
+                                                      transform_path=f'{ETL_URL}/transform_document_types',
+                                                      snapshot_date=[today.year, today.month],
+                                                      compression_level=6)
+
+        # the array tasks unpickle the snapshot
+        with open(f'{ETL_URL}/document_type_snapshot.pkl', 'wb') as out:
+            pickle.dump(document_type_snapshot, out, pickle.HIGHEST_PROTOCOL)
+
+        logging.info('Snapshot object saved.')
+
+    @dag.task(deps=['snapshot'], retries=2)
+    def submit(snapshot):
+        # every array task transforms its own shard of the parts, the finalize job merges their manifests
+        array_job_id = execute_slurm_file(job_name='document_types_snapshot',
+                                          mail_type='ALL',
+                                          mail_user=f'{MAIL_USER}',
+                                          partition='medium',
+                                          constraint='scratch',
+                                          cpus_per_task=16,
+                                          ntasks=1,
+                                          nodes=1,
+                                          mem='100GB',
+                                          dependency=None,
+                                          time=[0, 24, 0, 0],
+                                          cmd='module load python',
+                                          marker_dir=f'{LOG_URL}',
+                                          array=array_range(ARRAY_SIZE),
+                                          slurm_job='python ../workflows/document_types.py')
+
+        job_id = execute_slurm_file(job_name='document_types_snapshot_finalize',
+                                    mail_type='ALL',
+                                    mail_user=f'{MAIL_USER}',
+                                    partition='medium',
+                                    constraint='scratch',
+                                    cpus_per_task=1,
+                                    ntasks=1,
+                                    nodes=1,
+                                    mem='4GB',
+                                    dependency=array_job_id,
+                                    time=[0, 1, 0, 0],
+                                    cmd='module load python',
+                                    marker_dir=f'{LOG_URL}',
+                                    slurm_job=f'python ../workflows/document_types.py finalize {ARRAY_SIZE}')
+
+        logging.info(f'Slurm job ids: {array_job_id} (array), {job_id} (finalize)')
+
+        return [array_job_id, job_id]
+
+    # the job ids are persisted, so a restarted scheduler waits for the submitted jobs
+    # instead of submitting them again; reset document_types.submit to resubmit them
+    @dag.task(deps=['submit'])
+    def transform(submit):
+        array_job_id, job_id = submit
+
+        job_status = wait_for_jobs([array_job_id], marker_dir=f'{LOG_URL}')[array_job_id]
+
+        if job_status == 'COMPLETED':
+            job_status = wait_for_jobs([job_id], marker_dir=f'{LOG_URL}')[job_id]
+        else:
+            # the finalize job would wait for its dependency forever
+            cancel_jobs([job_id])
+
+        logging.info(f'Slurm job status: {job_status}.')
+
+        if job_status != 'COMPLETED':
+            raise RuntimeError(f'Slurm jobs {submit} ended with state {job_status}.')
+
+    if STORAGE_WRITE_API:
+
+        @dag.task(deps=['transform'], retries=2)
+        def commit(transform):
+            # the finalize job merged the manifests of all array tasks, so all streams are committed at once
+            stream_names = read_streams(f'{ETL_URL}/transform_document_types')
+
+            logging.info(f'Committing {len(stream_names)} streams.')
+            commit_time = storage_write_sink().commit(stream_names)
+            logging.info(f'Streams committed at {commit_time}.')
+
+            return len(stream_names)
+
+        @dag.task(deps=['commit'], retries=2)
+        def load(commit):
+            logging.info(f'Copying Table in Google BigQuery.')
+            copy_table_in_bq(source_table_id=PENDING_TABLE_ID,
+                             table_id='document_types_snapshot',
+                             project_id='subugoe-wag-closed',
+                             dataset_id='oal_doctypes',
+                             write_disposition='WRITE_TRUNCATE',
+                             table_description='Document Type Classification')
 
-logging.info('Snapshot object created.')
-logging.info('Saving Snapshot object.')
+            drop_table_in_bq(table_id=PENDING_TABLE_ID,
+                             project_id='subugoe-wag-closed',
+                             dataset_id='oal_doctypes')
 
-with open(f'{ETL_URL}/document_type_snapshot.pkl', 'wb') as out:
-    pickle.dump(document_type_snapshot, out, pickle.HIGHEST_PROTOCOL)
+            logging.info(f'Table in Google BigQuery was created.')
 
-logging.info('Snapshot object saved.')
+        return dag
 
-logging.info('Running slurm job.')
-job_id = execute_slurm_file(job_name='document_types_snapshot',
-                            mail_type='ALL',
-                            mail_user=f'{MAIL_USER}',
-                            partition='medium',
-                            constraint='scratch',
-                            cpus_per_task=16,
-                            ntasks=1,
-                            nodes=1,
-                            mem='100GB',
-                            dependency=None,
-                            time=[0, 24, 0, 0],
-                            cmd='module load python',
-                            slurm_job='python ../workflows/document_types.py')
+    # runs next to transform and uploads every part as soon as an array task finished it,
+    # so the upload overlaps the transform instead of following it; a retry skips the parts
+    # an earlier attempt uploaded already
+    @dag.task(deps=['submit'], retries=3)
+    def upload(submit):
+        array_job_id, job_id = submit
 
-logging.info(f'Slurm job id: {job_id}')
+        logging.info(f'Upload files to Google Bucket.')
+        with PipelinedUploader(bucket_name='bigschol',
+                               gcb_dir='transform_document_types',
+                               root=f'{ETL_URL}/transform_document_types',
+                               sync=True) as uploader:
 
-job_status = get_job_status(job_id)
+            try:
+                follow_manifests(f'{ETL_URL}/transform_document_types',
+                                 uploader.put,
+                                 is_done=lambda: get_job_status(job_id) not in ACTIVE_STATES | {None},
+                                 interval=30,
+                                 timeout=UPLOAD_TIMEOUT)
+            except TimeoutError as e:
+                raise NonRetryableError(str(e)) from e
 
-while job_status in [None, 'PENDING', 'RUNNING']:
-    time.sleep(60)
-    job_status = get_job_status(job_id)
+            # uploading again can not make up for parts the jobs never transformed
+            job_status = get_job_status(job_id)
+            if job_status != 'COMPLETED':
+                raise NonRetryableError(f'Slurm job {job_id} ended with state {job_status}, '
+                                        f'not all parts were transformed.')
 
-if job_status == 'COMPLETED':
-    logging.info(f'Slurm job {job_id} ended.')
-    logging.info(f'Slurm job status: {job_status}.')
+            # the finalize job merged the manifests of all array tasks
+            parts = len(Manifest(f'{ETL_URL}/transform_document_types/{MANIFEST_NAME}').entries)
 
-    logging.info(f'Upload files to Google Bucket.')
-    upload_files_to_bucket(bucket_name='bigschol',
-                           file_path=f'{ETL_URL}/transform_document_types/*',
-                           gcb_dir='transform_document_types')
+            return len(uploader.close(expected_parts=parts))
 
-    logging.info(f'Creating Table in Google BigQuery.')
-    create_table_from_bucket(uri='gs://bigschol/transform_document_types/*',
-                             table_id='document_types_snapshot',
-                             project_id='subugoe-wag-closed',
-                             dataset_id='oal_doctypes',
-                             schema_file_path='../schemas/schema_document_types.json',
-                             source_format='jsonl',
-                             write_disposition='WRITE_TRUNCATE',
-                             table_description='Document Type Classification',
-                             ignore_unknown_values=True)
+    @dag.task(deps=['transform', 'upload'], retries=2)
+    def load(transform, upload):
+        logging.info(f'Creating Table in Google BigQuery.')
+        create_table_from_bucket(uri='gs://bigschol/transform_document_types/*',
+                                 table_id='document_types_snapshot',
+                                 project_id='subugoe-wag-closed',
+                                 dataset_id='oal_doctypes',
+                                 schema_file_path='../schemas/schema_document_types.json',
+                                 source_format='jsonl',
+                                 write_disposition='WRITE_TRUNCATE',
+                                 table_description='Document Type Classification',
+                                 ignore_unknown_values=True)
+
+        logging.info(f'Table in Google BigQuery was created.')
+
+    @dag.task(deps=['load'], retries=3)
+    def cleanup(load):
+        logging.info(f'Removing files in Google Bucket.')
+
+        delete_files_from_bucket(bucket_name='bigschol',
+                                 gcb_dir='transform_document_types')
+
+        logging.info(f'Successfully removed files in Google Bucket.')
 
-    logging.info(f'Table in Google BigQuery was created.')
+    return dag
 
-    logging.info(f'Removing files in Google Bucket.')
 
-    delete_files_from_bucket(bucket_name='bigschol',
-                             gcb_dir='transform_document_types')
+if __name__ == '__main__':
 
-    logging.info(f'Successfully removed files in Google Bucket.')
+    run_dags([build_dag()], state_path=STATE_PATH)
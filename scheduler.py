@@ -1,6 +1,10 @@
 import datetime
 import subprocess
 import json
+import os
+import time as time_module
+import logging
+import threading
 from typing import Union
 from simple_slurm import Slurm
 
@@ -17,7 +21,12 @@ def execute_slurm_file(job_name: str,
                        dependency: Union[int, None],
                        time: list[int],
                        cmd: str,
-                       slurm_job: str) -> int:
+                       slurm_job: str,
+                       marker_dir: str = None,
+                       array: str = None) -> int:
+
+    # array, e.g. array_range(16, 4), submits a job array; its tasks find their shard
+    # through SLURM_ARRAY_TASK_ID and SLURM_ARRAY_TASK_COUNT
 
     days, hours, minutes, seconds = time
 
@@ -35,37 +44,172 @@ def execute_slurm_file(job_name: str,
     )
 
     if dependency:
+        # for a job array, afterok waits until all of its tasks completed successfully
         slurm.add_arguments(dependency=dict(afterok=dependency))
 
+    if array:
+        slurm.add_arguments(array=array)
+
+    if marker_dir:
+        # acts as the job's epilog, so wait_for_jobs notices the end of the job without polling sacct
+        if array:
+            slurm.add_cmd(f'trap \'touch {marker_dir}/${{SLURM_ARRAY_JOB_ID}}_${{SLURM_ARRAY_TASK_ID}}\' EXIT')
+        else:
+            slurm.add_cmd(f'trap \'touch {marker_dir}/$SLURM_JOB_ID\' EXIT')
+
     slurm.add_cmd(cmd)
     job_id = slurm.sbatch(slurm_job)
 
     return job_id
 
 
-def get_job_info(job_id: int) -> object:
-    cmd = f'sacct -j {job_id} --json'
-    p = subprocess.Popen(cmd,
-                         shell=True,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE,
-                         executable='/bin/bash')
+def array_range(size: int, max_concurrent: int = None) -> str:
+    # --array value for tasks 0 to size - 1, at most max_concurrent of them running at once
+    array = f'0-{size - 1}'
+    if max_concurrent:
+        array += f'%{max_concurrent}'
+    return array
+
 
-    stdout, _ = p.communicate()
+def cancel_jobs(job_ids: list[int]) -> None:
+    subprocess.run(['scancel'] + [str(job_id) for job_id in job_ids], check=True)
 
-    stdout = stdout.decode('utf-8')
 
-    job_info = json.loads(stdout)
+def get_job_info(job_id: int) -> object:
+    # full accounting record of a job, use get_job_status for its state only
+    cmd = ['sacct', '-j', str(job_id), '--json']
+    stdout = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, text=True).stdout
+
+    try:
+        job_info = json.loads(stdout)
+    except ValueError as e:
+        raise ValueError(f'Could not parse sacct output for job {job_id}: {stdout[:200]!r}') from e
 
     return job_info
 
 
-def get_job_status(job_id: int) -> Union[str, None]:
-    job_info = get_job_info(job_id)
+# job id -> (time of the query, state), shared by all threads of the process
+JOB_STATES = {}
+JOB_STATES_LOCK = threading.Lock()
 
-    try:
-        job_status = job_info['jobs'][0]['state']['current']
-    except:
-        job_status = None
+
+def get_job_status(job_id: int, ttl: float = 10) -> Union[str, None]:
+    # None if sacct does not know the job (yet). Callers within ttl seconds share one
+    # query, and concurrent callers wait for it instead of querying the controller too.
+    job_id = int(job_id)
+
+    with JOB_STATES_LOCK:
+        cached = JOB_STATES.get(job_id)
+        if cached and time_module.monotonic() - cached[0] < ttl:
+            return cached[1]
+
+        job_status = get_job_states([job_id]).get(job_id)
+        JOB_STATES[job_id] = (time_module.monotonic(), job_status)
 
     return job_status
+
+
+# states of jobs that have not ended yet, see https://slurm.schedmd.com/sacct.html#SECTION_JOB-STATE-CODES
+ACTIVE_STATES = {'PENDING', 'CONFIGURING', 'RUNNING', 'COMPLETING', 'REQUEUED', 'RESIZING', 'SUSPENDED'}
+
+
+def aggregate_state(states: list[str]) -> str:
+    # an array job is active while any task is, and only completed if all tasks are
+    for state in states:
+        if state in ACTIVE_STATES:
+            return state
+
+    for state in states:
+        if state != 'COMPLETED':
+            return state
+
+    return 'COMPLETED'
+
+
+def get_job_states(job_ids: list[int]) -> dict[int, str]:
+    # one sacct call for all jobs; array tasks (<id>_<task>) are aggregated into their job
+    cmd = ['sacct',
+           '-X',
+           '-j', ','.join(str(job_id) for job_id in job_ids),
+           '--noheader',
+           '--parsable2',
+           '--format=JobID,State']
+
+    stdout = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, text=True).stdout
+
+    task_states = {}
+    for line in stdout.splitlines():
+        if not line.strip():
+            continue
+
+        job_id, _, state = line.partition('|')
+        base_job_id = job_id.split('_')[0].split('+')[0]
+
+        if not state.strip() or not base_job_id.isdigit():
+            raise ValueError(f'Could not parse sacct output line {line!r}.')
+
+        # e.g. 'CANCELLED by 1234'
+        task_states.setdefault(int(base_job_id), []).append(state.split()[0])
+
+    return {job_id: aggregate_state(states) for job_id, states in task_states.items() if job_id in job_ids}
+
+
+def find_markers(marker_dir: str, job_ids: list[int]) -> list[str]:
+    # markers are named <job id>, or <array job id>_<task id> for array tasks
+    prefixes = {str(job_id) for job_id in job_ids}
+    return [name for name in os.listdir(marker_dir) if name.split('_')[0] in prefixes]
+
+
+def wait_for_jobs(job_ids: list[int],
+                  timeout: float = None,
+                  min_interval: float = 5,
+                  max_interval: float = 300,
+                  backoff: float = 2,
+                  marker_dir: str = None,
+                  marker_interval: float = 1) -> dict[int, str]:
+
+    # Polls sacct for all jobs at once, starting every min_interval seconds and backing off
+    # to max_interval for long jobs. With marker_dir, the marker files written by jobs
+    # submitted with the same marker_dir (one per array task) are watched as well, and a
+    # new marker triggers a query right away and resets the backoff, since sacct may lag
+    # behind the marker while the job is COMPLETING.
+    job_ids = [int(job_id) for job_id in job_ids]
+    states = {}
+    markers = set()
+    start = time_module.monotonic()
+    interval = min_interval
+    next_query = start
+
+    while True:
+        now = time_module.monotonic()
+        pending = [job_id for job_id in job_ids if states.get(job_id) in ACTIVE_STATES or job_id not in states]
+
+        if marker_dir:
+            new_markers = set(find_markers(marker_dir, pending)) - markers
+            if new_markers:
+                markers |= new_markers
+                next_query = now
+                interval = min_interval
+
+        if now >= next_query:
+            states.update(get_job_states(pending))
+            pending = [job_id for job_id in pending if states.get(job_id) in ACTIVE_STATES or job_id not in states]
+
+            if not pending:
+                return {job_id: states[job_id] for job_id in job_ids}
+
+            logging.debug(f'Waiting for Slurm jobs {pending}.')
+
+            next_query = now + interval
+            interval = min(interval * backoff, max_interval)
+
+        if timeout is not None and now - start >= timeout:
+            raise TimeoutError(f'Slurm jobs {pending} did not end within {timeout} seconds.')
+
+        sleep = next_query - now
+        if marker_dir:
+            sleep = min(sleep, marker_interval)
+        if timeout is not None:
+            sleep = min(sleep, max(0.0, start + timeout - now))
+
+        time_module.sleep(max(sleep, 0.0))
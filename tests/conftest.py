@@ -0,0 +1,456 @@
+import pytest
+import os
+import re
+import sys
+import json
+import base64
+import google_crc32c
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class RangeServer(ThreadingHTTPServer):
+
+    # serves self.content under any path and honours single byte ranges
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), RangeRequestHandler)
+        self.content = b''
+        self.support_ranges = True
+        self.fail_ranges = set()
+        self.requests = []
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        content = server.content
+        range_header = self.headers.get('Range')
+
+        server.requests.append((self.path, range_header, dict(self.headers)))
+
+        if range_header in server.fail_ranges:
+            server.fail_ranges.discard(range_header)
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if range_header and server.support_ranges:
+            first_byte, last_byte = map(int, re.match(r'bytes=(\d+)-(\d+)', range_header).groups())
+            body = content[first_byte:last_byte + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {first_byte}-{first_byte + len(body) - 1}/{len(content)}')
+        else:
+            body = content
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def range_server():
+    server = RangeServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class FakeLoadJob:
+
+    def __init__(self, client, job_config):
+        self.client = client
+        self.job_config = job_config
+
+    def result(self):
+        with self.client.condition:
+            # appending jobs hold until overlap of them run at once, so that a test sees real
+            # concurrency however the threads are scheduled
+            if self.job_config.write_disposition == 'WRITE_APPEND':
+                self.client.condition.wait_for(lambda: self.client.in_flight >= self.client.overlap, timeout=5)
+
+        time.sleep(self.client.job_duration)
+        with self.client.condition:
+            self.client.in_flight -= 1
+        return self
+
+
+class FakeCopyJob:
+
+    def result(self):
+        return self
+
+
+class FakeBigQueryClient:
+
+    # records load jobs and how many of them were in flight at the same time, and keeps
+    # tables created or copied by reference
+
+    def __init__(self, job_duration: float = 0.02, overlap: int = 1):
+        self.job_duration = job_duration
+        self.overlap = overlap
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.loads = []
+        self.tables = {}
+        self.copies = []
+
+    def load_table_from_file(self, file_obj, destination, job_config=None, size=None, **kwargs):
+        content = file_obj.read()
+        assert size is None or size == len(content)
+        with self.condition:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.loads.append((destination, job_config.write_disposition, content))
+            self.condition.notify_all()
+        return FakeLoadJob(self, job_config)
+
+    def delete_table(self, table, not_found_ok=False):
+        if self.tables.pop(str(table), None) is None:
+            assert not_found_ok
+
+    def create_table(self, table):
+        assert str(table.reference) not in self.tables
+        self.tables[str(table.reference)] = table
+
+    def get_table(self, table):
+        return self.tables[str(table)]
+
+    def update_table(self, table, fields):
+        self.tables[str(table.reference)] = table
+        return table
+
+    def copy_table(self, source, destination, job_config=None):
+        from google.cloud import bigquery
+        assert str(source) in self.tables
+        if str(destination) in self.tables:
+            assert job_config.write_disposition == bigquery.WriteDisposition.WRITE_TRUNCATE
+        table = bigquery.Table(destination, schema=self.tables[str(source)].schema)
+        table.description = self.tables[str(source)].description
+        self.tables[str(destination)] = table
+        self.copies.append((str(source), str(destination)))
+        return FakeCopyJob()
+
+
+@pytest.fixture
+def bigquery_client(monkeypatch):
+    import bq_utils
+    client = FakeBigQueryClient()
+    monkeypatch.setattr(bq_utils, 'get_bigquery_client', lambda project=None, credentials=None: client)
+    return client
+
+
+class FakeBlob:
+
+    def __init__(self, bucket, name, size=None, crc32c=None):
+        self.bucket = bucket
+        self.name = name
+        self.size = size
+        self.crc32c = crc32c
+
+    def upload_from_filename(self, filename):
+        with open(filename, 'rb') as file:
+            self.bucket.client.put(self.bucket.name, self.name, file.read())
+
+    def download_to_filename(self, filename):
+        content = self.bucket.client.get(self.bucket.name, self.name)
+        with open(filename, 'wb') as file:
+            file.write(content)
+
+    def delete(self):
+        client = self.bucket.client
+        batch = client.current_batch
+        if batch is not None:
+            batch.deferred.append((self.bucket.name, self.name))
+        else:
+            client.delete(self.bucket.name, self.name)
+
+
+class FakeBucket:
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def blob(self, blob_name):
+        return FakeBlob(self, blob_name)
+
+    def list_blobs(self, prefix='', fields=None):
+        with self.client.lock:
+            objects = sorted(self.client.objects.items())
+        return [FakeBlob(self, name, len(content), base64.b64encode(google_crc32c.Checksum(content).digest()).decode())
+                for (bucket_name, name), content in objects
+                if bucket_name == self.name and name.startswith(prefix)]
+
+
+class FakeResponse:
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeBatch:
+
+    # collects deletions and sends them as one request, failing the items listed in client.failures
+
+    def __init__(self, client, raise_exception=True):
+        self.client = client
+        self.raise_exception = raise_exception
+        self.deferred = []
+        self._responses = []
+
+    def __enter__(self):
+        self.client.batches.stack = [self] + getattr(self.client.batches, 'stack', [])
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.client.batches.stack = self.client.batches.stack[1:]
+        if exc_type is None:
+            assert len(self.deferred) <= 100
+            self.client.request('BATCH', None, None)
+            for bucket_name, blob_name in self.deferred:
+                with self.client.lock:
+                    failures = self.client.failures.get(blob_name, 0)
+                    self.client.failures[blob_name] = failures - 1
+                    if failures > 0:
+                        self._responses.append(FakeResponse(503))
+                    elif self.client.objects.pop((bucket_name, blob_name), None) is not None:
+                        self._responses.append(FakeResponse(204))
+                    else:
+                        self._responses.append(FakeResponse(404))
+
+
+class FakeStorageClient:
+
+    # keeps objects in memory and sleeps latency seconds per request, like a remote round-trip
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.requests = []
+        self.failures = {}
+        self.batches = threading.local()
+
+    @property
+    def current_batch(self):
+        stack = getattr(self.batches, 'stack', [])
+        return stack[0] if stack else None
+
+    def batch(self, raise_exception=True):
+        return FakeBatch(self, raise_exception)
+
+    def request(self, method, bucket_name, blob_name):
+        time.sleep(self.latency)
+        with self.lock:
+            self.requests.append((method, bucket_name, blob_name))
+
+    def put(self, bucket_name, blob_name, content):
+        self.request('PUT', bucket_name, blob_name)
+        with self.lock:
+            self.objects[bucket_name, blob_name] = content
+
+    def get(self, bucket_name, blob_name):
+        self.request('GET', bucket_name, blob_name)
+        with self.lock:
+            return self.objects[bucket_name, blob_name]
+
+    def delete(self, bucket_name, blob_name):
+        self.request('DELETE', bucket_name, blob_name)
+        with self.lock:
+            del self.objects[bucket_name, blob_name]
+
+    def bucket(self, bucket_name):
+        return FakeBucket(self, bucket_name)
+
+
+@pytest.fixture
+def storage_client(monkeypatch):
+    import bq_utils
+    client = FakeStorageClient()
+    monkeypatch.setattr(bq_utils, 'get_storage_client', lambda project=None, credentials=None: client)
+    return client
+
+
+class StubWriteClient:
+
+    # an in-memory Storage Write API with pending streams, decoding rows with the writer schema
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.streams = {}
+        self.finalized = set()
+        self.tables = {}
+        self.append_requests = []
+
+    def create_write_stream(self, parent, write_stream):
+        from google.cloud.bigquery_storage_v1 import types
+        assert write_stream.type_ == types.WriteStream.Type.PENDING
+        with self.lock:
+            name = f'{parent}/streams/{len(self.streams)}'
+            self.streams[name] = []
+        return types.WriteStream(name=name, type_=write_stream.type_)
+
+    def append_rows(self, requests, metadata=()):
+        from google.cloud.bigquery_storage_v1 import types
+        from google.protobuf import descriptor_pb2, descriptor_pool, json_format, message_factory
+
+        for request in requests:
+            # like the backend, which routes the connection by the stream in the metadata
+            assert ('x-goog-request-params', f'write_stream={request.write_stream}') in metadata
+            descriptor = descriptor_pb2.DescriptorProto.FromString(
+                type(request.proto_rows.writer_schema).pb(request.proto_rows.writer_schema).proto_descriptor.SerializeToString())
+            pool = descriptor_pool.DescriptorPool()
+            pool.Add(descriptor_pb2.FileDescriptorProto(name='stub.proto', syntax='proto2', message_type=[descriptor]))
+            message_class = message_factory.GetMessageClass(pool.FindMessageTypeByName(descriptor.name))
+
+            rows = self.streams[request.write_stream]
+            assert request.write_stream not in self.finalized
+            assert request.offset == len(rows)
+            self.append_requests.append((request.write_stream, request.offset, len(request.proto_rows.rows.serialized_rows)))
+
+            for row in request.proto_rows.rows.serialized_rows:
+                rows.append(json_format.MessageToDict(message_class.FromString(row), preserving_proto_field_name=True))
+
+            yield types.AppendRowsResponse(append_result=types.AppendRowsResponse.AppendResult(offset=request.offset))
+
+    def finalize_write_stream(self, name):
+        from google.cloud.bigquery_storage_v1 import types
+        self.finalized.add(name)
+        return types.FinalizeWriteStreamResponse(row_count=len(self.streams[name]))
+
+    def batch_commit_write_streams(self, request):
+        from google.cloud.bigquery_storage_v1 import types
+        errors = [types.StorageError(entity=name, error_message='Stream is not finalized.')
+                  for name in request.write_streams if name not in self.finalized]
+        if errors:
+            return types.BatchCommitWriteStreamsResponse(stream_errors=errors)
+        table = self.tables.setdefault(request.parent, [])
+        for name in request.write_streams:
+            table.extend(self.streams[name])
+        return types.BatchCommitWriteStreamsResponse(commit_time={'seconds': 1})
+
+
+@pytest.fixture
+def write_client():
+    return StubWriteClient()
+
+
+class DirectorySink:
+
+    # a sink for the storage_write output format that keeps every stream in a file of its own,
+    # so that streams written by worker processes can be committed by the test
+
+    def __init__(self, directory):
+        self.directory = str(directory)
+
+    def write(self, records) -> str:
+        stream_name = os.path.join(self.directory, f'stream-{os.getpid()}-{time.perf_counter_ns()}.json')
+        with open(stream_name, 'w') as file:
+            json.dump(list(records), file)
+        return stream_name
+
+    def commit(self, stream_names: list[str]) -> list[dict]:
+        rows = []
+        for stream_name in stream_names:
+            with open(stream_name, 'r') as file:
+                rows.extend(json.load(file))
+        return rows
+
+
+@pytest.fixture
+def directory_sink(tmp_path):
+    return DirectorySink(tmp_path)
+
+
+FAKE_SACCT = '''#!{python}
+# prints the next state of every job in sacct.json, logging its arguments to calls.jsonl
+import json, os, sys
+directory = os.path.dirname(os.path.abspath(__file__))
+with open(os.path.join(directory, 'calls.jsonl'), 'a') as file:
+    file.write(json.dumps(sys.argv[1:]) + '\\n')
+with open(os.path.join(directory, 'sacct.json')) as file:
+    jobs = json.load(file)
+job_ids = sys.argv[sys.argv.index('-j') + 1].split(',')
+for job_id, states in jobs.items():
+    if job_id.split('_')[0] in job_ids:
+        print(job_id + '|' + states[0])
+        if len(states) > 1:
+            states.pop(0)
+with open(os.path.join(directory, 'sacct.json'), 'w') as file:
+    json.dump(jobs, file)
+'''
+
+
+FAKE_SBATCH = '''#!{python}
+# saves the submitted script as sbatch-<job id>.sh and reports the job id
+import os, sys
+directory = os.path.dirname(os.path.abspath(__file__))
+job_id = 1000 + len([name for name in os.listdir(directory) if name.startswith('sbatch-')])
+script = open(sys.argv[1]).read() if len(sys.argv) > 1 else sys.stdin.read()
+with open(os.path.join(directory, f'sbatch-{job_id}.sh'), 'w') as file:
+    file.write(script)
+print(f'Submitted batch job {job_id}')
+'''
+
+
+class FakeSlurm:
+
+    # a directory on PATH with fake Slurm commands
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.write_command('sacct', FAKE_SACCT)
+        self.write_command('sbatch', FAKE_SBATCH)
+        self.set_jobs({})
+
+    def scripts(self) -> dict:
+        # job id -> submitted script
+        scripts = {}
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith('sbatch-'):
+                with open(os.path.join(self.directory, name)) as file:
+                    scripts[int(name[7:-3])] = file.read()
+        return scripts
+
+    def write_command(self, name, source):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as file:
+            file.write(source.replace('{python}', sys.executable))
+        os.chmod(path, 0o755)
+
+    def set_jobs(self, jobs):
+        # job id -> states returned by successive sacct calls
+        with open(os.path.join(self.directory, 'sacct.json'), 'w') as file:
+            json.dump(jobs, file)
+
+    def calls(self, name='calls.jsonl'):
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            return []
+        with open(path) as file:
+            return [json.loads(line) for line in file]
+
+
+@pytest.fixture
+def fake_slurm(tmp_path, monkeypatch):
+    directory = tmp_path / 'bin'
+    directory.mkdir()
+    monkeypatch.setenv('PATH', f'{directory}{os.pathsep}{os.environ["PATH"]}')
+    return FakeSlurm(str(directory))
@@ -1,9 +1,27 @@
 import pytest
 import os
+import gzip
+import json
+import pickle
+import base64
 import shutil
-from bq_utils import (create_table_from_local,
+import requests
+from concurrent.futures import ThreadPoolExecutor
+import bq_utils
+from bq_utils import (ChainedFile,
+                      JobConfig,
+                      PipelinedUploader,
+                      StorageWriteSink,
+                      get_bigquery_client,
+                      get_storage_client,
+                      load_schema,
+                      mount_connection_pool,
+                      group_files,
+                      create_table_from_local,
                       upload_files_to_bucket,
                       create_table_from_bucket,
+                      create_empty_table,
+                      copy_table_in_bq,
                       delete_files_from_bucket,
                       drop_table_in_bq,
                       download_file_from_bucket,
@@ -20,6 +38,431 @@ class TestBqUtils:
         yield 'directory'
         shutil.rmtree(os.path.join(self.test_dir, 'google_cloud'), ignore_errors=True)
 
+    def test_clients_created_once(self, monkeypatch):
+        created = []
+
+        class Client:
+            def __init__(self, project=None, credentials=None):
+                created.append((type(self), project))
+
+        monkeypatch.setattr(bq_utils, 'CLIENTS', {})
+        monkeypatch.setattr(bq_utils.bigquery, 'Client', Client)
+        monkeypatch.setattr(bq_utils.storage, 'Client', type('Client', (Client,), {}))
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            clients = list(executor.map(lambda _: get_bigquery_client(), range(32)))
+
+        assert len(created) == 1
+        assert all(client is clients[0] for client in clients)
+        assert JobConfig(project_id='project', dataset_id='dataset').client is clients[0]
+
+        assert get_storage_client() is get_storage_client()
+        assert get_bigquery_client('other') is not clients[0]
+        assert len(created) == 3
+
+    def test_load_schema(self, tmp_path):
+        schema_file_path = tmp_path / 'schema.json'
+        schema_file_path.write_text(json.dumps([{'name': 'doi', 'type': 'STRING', 'mode': 'NULLABLE'}]))
+
+        schema = load_schema(str(schema_file_path))
+        assert [field.name for field in schema] == ['doi']
+        assert bq_utils.read_schema.cache_info().currsize >= 1
+
+        hits = bq_utils.read_schema.cache_info().hits
+        load_schema(str(schema_file_path))
+        assert bq_utils.read_schema.cache_info().hits == hits + 1
+
+        schema_file_path.write_text(json.dumps([{'name': 'title', 'type': 'STRING', 'mode': 'NULLABLE'}]))
+        os.utime(schema_file_path, (0, 0))
+        assert [field.name for field in load_schema(str(schema_file_path))] == ['title']
+
+    def test_mount_connection_pool(self):
+        session = requests.Session()
+        mount_connection_pool(type('Client', (), {'_http': session})(), pool_size=48)
+        assert session.get_adapter('https://storage.googleapis.com')._pool_maxsize == 48
+
+    def test_upload_download_files(self, storage_client, local_files, tmp_path, monkeypatch):
+        chunked = []
+
+        def upload_chunks_concurrently(filename, blob, chunk_size, worker_type, max_workers):
+            chunked.append((blob.name, chunk_size, worker_type))
+            blob.upload_from_filename(filename)
+
+        def download_chunks_concurrently(blob, filename, chunk_size, worker_type, max_workers):
+            chunked.append((blob.name, chunk_size, worker_type))
+            blob.download_to_filename(filename)
+
+        monkeypatch.setattr(bq_utils.transfer_manager, 'upload_chunks_concurrently', upload_chunks_concurrently)
+        monkeypatch.setattr(bq_utils.transfer_manager, 'download_chunks_concurrently', download_chunks_concurrently)
+        monkeypatch.chdir(tmp_path)
+
+        large_file_size = os.path.getsize(local_files[-1])
+
+        upload_files_to_bucket(bucket_name='bigschol',
+                               file_path='*.jsonl',
+                               gcb_dir='test',
+                               max_workers=4,
+                               large_file_size=large_file_size,
+                               chunk_size=16)
+
+        assert sorted(name for _, name in storage_client.objects) == sorted(f'test/{os.path.basename(file)}' for file in local_files)
+        assert chunked == [('test/part_09.jsonl', 16, 'thread')]
+
+        os.makedirs('download')
+        download_files_from_bucket(bucket_name='bigschol',
+                                   gcb_dir='test',
+                                   file_path='download',
+                                   max_workers=4,
+                                   large_file_size=large_file_size)
+
+        for file in local_files:
+            with open(file, 'rb') as original, open(os.path.join('download', os.path.basename(file)), 'rb') as downloaded:
+                assert original.read() == downloaded.read()
+
+        assert len(chunked) == 2
+
+    def test_upload_files_to_bucket_sync(self, storage_client, local_files, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+
+        result = upload_files_to_bucket(bucket_name='bigschol', file_path='*.jsonl', gcb_dir='test', sync=True)
+        assert result == {'uploaded': 10, 'skipped': 0, 'deleted': 0}
+
+        with open(local_files[3], 'ab') as file:
+            file.write(b'{"doi": "10.3/new"}\n')
+        storage_client.objects['bigschol', 'test/orphan.jsonl'] = b''
+        storage_client.objects['bigschol', 'other/orphan.jsonl'] = b''
+        storage_client.requests.clear()
+
+        result = upload_files_to_bucket(bucket_name='bigschol',
+                                        file_path='*.jsonl',
+                                        gcb_dir='test',
+                                        sync=True,
+                                        delete_orphans=True)
+
+        assert result == {'uploaded': 1, 'skipped': 9, 'deleted': 1}
+        assert [request for request in storage_client.requests if request[0] == 'PUT'] == [('PUT', 'bigschol', 'test/part_03.jsonl')]
+        assert storage_client.objects['bigschol', 'test/part_03.jsonl'] == open(local_files[3], 'rb').read()
+        assert ('bigschol', 'test/orphan.jsonl') not in storage_client.objects
+        assert ('bigschol', 'other/orphan.jsonl') in storage_client.objects
+
+    def test_transfer_max_processes_alias(self, storage_client, local_files, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+
+        with pytest.deprecated_call():
+            result = upload_files_to_bucket(bucket_name='bigschol', file_path='*.jsonl', gcb_dir='test', max_processes=2)
+        assert result['uploaded'] == 10
+
+        os.makedirs('download')
+        with pytest.deprecated_call():
+            download_files_from_bucket(bucket_name='bigschol', gcb_dir='test', file_path='download', max_processes=2)
+        assert len(os.listdir('download')) == 10
+
+    def test_pipelined_uploader(self, storage_client, tmp_path, monkeypatch):
+        storage_client.latency = 0.05
+        loads = []
+        monkeypatch.setattr(bq_utils, 'create_table_from_bucket', lambda **kwargs: loads.append(kwargs))
+
+        with PipelinedUploader(bucket_name='bigschol',
+                               gcb_dir='test',
+                               root=str(tmp_path),
+                               max_workers=4,
+                               load_config=dict(table_id='cr_instant', source_format='jsonl')) as uploader:
+
+            for i in range(8):
+                part = tmp_path / f'updated_date={i % 2}' / f'part_{i}.jsonl.gz'
+                part.parent.mkdir(exist_ok=True)
+                part.write_bytes(b'x' * (i + 1))
+                uploader.put(str(part))
+                uploader.put(str(part))
+
+                # parts are uploaded while the next ones are still being produced
+                if i == 0:
+                    uploader.futures[str(part)].result(timeout=5)
+                    assert ('bigschol', 'test/updated_date=0/part_0.jsonl.gz') in storage_client.objects
+
+            assert not loads
+
+            assert len(uploader.close(expected_parts=8)) == 8
+
+        assert sorted(name for _, name in storage_client.objects) == sorted(f'test/updated_date={i % 2}/part_{i}.jsonl.gz' for i in range(8))
+        assert storage_client.objects['bigschol', 'test/updated_date=1/part_3.jsonl.gz'] == b'xxxx'
+        assert len([request for request in storage_client.requests if request[0] == 'PUT']) == 8
+        assert loads == [dict(uri='gs://bigschol/test/*', table_id='cr_instant', source_format='jsonl')]
+
+    def test_pipelined_uploader_sync(self, storage_client, tmp_path):
+        parts = []
+        for i in range(4):
+            part = tmp_path / f'part_{i}.jsonl.gz'
+            part.write_bytes(b'x' * (i + 1))
+            parts.append(str(part))
+
+        # an earlier attempt uploaded two parts, one of which changed since
+        storage_client.objects['bigschol', 'test/part_0.jsonl.gz'] = b'x'
+        storage_client.objects['bigschol', 'test/part_1.jsonl.gz'] = b'y'
+
+        with PipelinedUploader(bucket_name='bigschol', gcb_dir='test', root=str(tmp_path), sync=True) as uploader:
+            for part in parts:
+                uploader.put(part)
+
+            assert len(uploader.close(expected_parts=4)) == 4
+
+        assert sorted(name for method, _, name in storage_client.requests if method == 'PUT') == ['test/part_1.jsonl.gz',
+                                                                                                  'test/part_2.jsonl.gz',
+                                                                                                  'test/part_3.jsonl.gz']
+        assert storage_client.objects['bigschol', 'test/part_1.jsonl.gz'] == b'xx'
+
+    def test_pipelined_uploader_incomplete(self, storage_client, tmp_path, monkeypatch):
+        loads = []
+        monkeypatch.setattr(bq_utils, 'create_table_from_bucket', lambda **kwargs: loads.append(kwargs))
+
+        part = tmp_path / 'part_0.jsonl.gz'
+        part.write_bytes(b'x')
+
+        uploader = PipelinedUploader(bucket_name='bigschol', gcb_dir='test', root=str(tmp_path), load_config={})
+        uploader.put(str(part))
+
+        with pytest.raises(RuntimeError):
+            uploader.close(expected_parts=2)
+
+        # a failing producer never triggers the load
+        with pytest.raises(ValueError):
+            with PipelinedUploader(bucket_name='bigschol', gcb_dir='test', load_config={}) as uploader:
+                uploader.put(str(part))
+                raise ValueError('Transform failed.')
+
+        assert not loads
+
+    def test_file_crc32c(self, tmp_path):
+        file_path = tmp_path / 'file'
+        file_path.write_bytes(b'123456789')
+        # CRC32C check value
+        assert bq_utils.file_crc32c(str(file_path), buffer_size=4) == base64.b64encode(bytes.fromhex('e3069283')).decode()
+
+    def test_delete_files_from_bucket_batched(self, storage_client, monkeypatch):
+        monkeypatch.setattr(bq_utils.time, 'sleep', lambda seconds: None)
+
+        for i in range(250):
+            storage_client.objects['bigschol', f'test/part_{i:03d}.jsonl.gz'] = b''
+        storage_client.objects['bigschol', 'other/part_000.jsonl.gz'] = b''
+
+        storage_client.failures = {'test/part_007.jsonl.gz': 1,
+                                   'test/part_123.jsonl.gz': 2,
+                                   'test/part_200.jsonl.gz': 10}
+
+        result = delete_files_from_bucket(bucket_name='bigschol',
+                                          gcb_dir='test',
+                                          max_workers=3,
+                                          retries=2)
+
+        assert result == {'deleted': 249, 'failed': 1}
+        assert sorted(storage_client.objects) == [('bigschol', 'other/part_000.jsonl.gz'),
+                                                  ('bigschol', 'test/part_200.jsonl.gz')]
+        # three batches of up to 100 deletions, then two retry rounds
+        assert [method for method, _, _ in storage_client.requests].count('BATCH') == 5
+
+    def test_storage_write_sink(self, write_client):
+        sink = StorageWriteSink(project_id='subugoe-collaborative',
+                                dataset_id='resources',
+                                table_id='test_subslurm_bq_functions',
+                                schema_file_path=os.path.join(self.test_dir, '../schemas/schema_crossref.json'),
+                                write_client=write_client,
+                                max_request_size=4096)
+
+        with gzip.open(os.path.join(self.test_dir, 'test_files_crossref/crossref_sample_transformed.jsonl.gz')) as file:
+            records = [json.loads(line) for line in file]
+
+        stream_names = [sink.write(iter(records[:60])), sink.write(iter(records[60:])), sink.write(iter([]))]
+
+        # pending rows are invisible until the streams are committed
+        assert sink.table_path not in write_client.tables
+        assert len({offset for _, offset, _ in write_client.append_requests}) > 1
+
+        sink.commit(stream_names)
+
+        rows = write_client.tables[sink.table_path]
+        assert [row['doi'] for row in rows] == [record['doi'] for record in records]
+        assert [row.get('title') for row in rows] == [record['title'] or None for record in records]
+        assert rows[0]['license'][0]['delay_in_days'] in ('0', 0)
+
+    def test_storage_write_sink_commit_error(self, write_client):
+        sink = StorageWriteSink(project_id='subugoe-collaborative',
+                                dataset_id='resources',
+                                table_id='test_subslurm_bq_functions',
+                                schema_file_path=os.path.join(self.test_dir, '../schemas/schema_document_types.json'),
+                                write_client=write_client)
+
+        stream_name = write_client.create_write_stream(
+            parent=sink.table_path,
+            write_stream=bq_utils.types.WriteStream(type_=bq_utils.types.WriteStream.Type.PENDING)).name
+
+        with pytest.raises(RuntimeError):
+            sink.commit([stream_name])
+
+        sink.write_client = None
+        assert pickle.loads(pickle.dumps(sink)).table_path == sink.table_path
+
+    def test_create_and_copy_table(self, bigquery_client):
+        schema_file_path = os.path.join(self.test_dir, '../schemas/schema_document_types.json')
+
+        create_empty_table(table_id='pending',
+                           project_id='subugoe-collaborative',
+                           dataset_id='resources',
+                           schema_file_path=schema_file_path)
+        create_empty_table(table_id='pending',
+                           project_id='subugoe-collaborative',
+                           dataset_id='resources',
+                           schema_file_path=schema_file_path)
+        create_empty_table(table_id='target',
+                           project_id='subugoe-collaborative',
+                           dataset_id='resources',
+                           schema_file_path=schema_file_path)
+
+        copy_table_in_bq(source_table_id='pending',
+                         table_id='target',
+                         project_id='subugoe-collaborative',
+                         dataset_id='resources',
+                         write_disposition='WRITE_TRUNCATE',
+                         table_description='Document Type Classification')
+
+        assert bigquery_client.copies == [('subugoe-collaborative.resources.pending',
+                                           'subugoe-collaborative.resources.target')]
+        target = bigquery_client.tables['subugoe-collaborative.resources.target']
+        assert target.description == 'Document Type Classification'
+        assert [field.name for field in target.schema] == [field['name'] for field in json.load(open(schema_file_path))]
+
+    def test_fill_message(self, tmp_path):
+        schema_file_path = tmp_path / 'schema.json'
+        schema_file_path.write_text(json.dumps([
+            {'name': 'doi', 'type': 'STRING', 'mode': 'NULLABLE'},
+            {'name': 'volume', 'type': 'INTEGER', 'mode': 'NULLABLE'},
+            {'name': 'proba', 'type': 'float', 'mode': 'NULLABLE'},
+            {'name': 'published', 'type': 'DATE', 'mode': 'NULLABLE'},
+            {'name': 'isbn', 'type': 'STRING', 'mode': 'REPEATED'},
+            {'name': 'author', 'type': 'RECORD', 'mode': 'REPEATED',
+             'fields': [{'name': 'given', 'type': 'STRING', 'mode': 'NULLABLE'}]}]))
+
+        descriptor, message_class, converter = bq_utils.load_proto_schema(str(schema_file_path))
+        message = message_class()
+        bq_utils.fill_message(message,
+                              {'doi': 10, 'volume': '12', 'proba': 0.25, 'published': [], 'isbn': ['1', None],
+                               'author': [{'given': 'Nick', 'family': 'Haupka'}], 'unknown': 1},
+                              converter)
+
+        assert message.doi == '10'
+        assert message.volume == 12
+        assert message.proba == 0.25
+        assert not message.HasField('published')
+        assert list(message.isbn) == ['1']
+        assert message.author[0].given == 'Nick'
+
+        # dates are converted to datetime.date like for the parquet output and sent in their string form
+        message = message_class()
+        bq_utils.fill_message(message, {'published': '2024-07-01', 'author': {'given': 1}}, converter)
+
+        assert message.published == '2024-07-01'
+        assert message.author[0].given == '1'
+
+    @pytest.fixture
+    def local_files(self, tmp_path):
+        files = []
+        for i in range(10):
+            file_path = tmp_path / f'part_{i:02d}.jsonl'
+            file_path.write_bytes(b''.join(b'{"doi": "10.%d/%d"}\n' % (i, j) for j in range(i + 1)))
+            files.append(str(file_path))
+        return files
+
+    def test_chained_file(self, local_files):
+        content = b''.join(open(file, 'rb').read() for file in local_files)
+        with ChainedFile(local_files) as chained_file:
+            assert chained_file.size == len(content)
+            assert chained_file.read(7) == content[:7]
+            assert chained_file.tell() == 7
+            assert chained_file.read() == content[7:]
+            chained_file.seek(100)
+            assert chained_file.read(50) == content[100:150]
+
+    def test_chained_file_line_breaks(self, tmp_path):
+        parts = [(b'{"doi": "10.1/1"}\n{"doi": "10.1/2"}', 'part_0.jsonl'),
+                 (b'', 'part_1.jsonl'),
+                 (b'{"doi": "10.1/3"}\n', 'part_2.jsonl'),
+                 (gzip.compress(b'{"doi": "10.1/4"}'), 'part_3.jsonl.gz'),
+                 (b'{"doi": "10.1/5"}', 'part_4.jsonl')]
+        for content, name in parts:
+            (tmp_path / name).write_bytes(content)
+        files = [str(tmp_path / name) for _, name in parts]
+
+        # the last row of a file without a final line break does not run into the next file
+        content = b'{"doi": "10.1/1"}\n{"doi": "10.1/2"}\n{"doi": "10.1/3"}\n' + parts[3][0] + b'{"doi": "10.1/5"}\n'
+        with ChainedFile(files, line_breaks=True) as chained_file:
+            assert chained_file.size == len(content)
+            assert chained_file.read() == content
+            chained_file.seek(30)
+            assert chained_file.read(10) == content[30:40]
+
+        with ChainedFile(files) as chained_file:
+            assert chained_file.read() == b''.join(content for content, _ in parts)
+
+    def test_create_table_from_local_line_breaks(self, bigquery_client, tmp_path):
+        (tmp_path / 'part_0.jsonl').write_bytes(b'{"doi": "10.1/1"}')
+        (tmp_path / 'part_1.jsonl').write_bytes(b'{"doi": "10.1/2"}')
+
+        create_table_from_local(table_id='test_subslurm_bq_functions',
+                                project_id='subugoe-collaborative',
+                                dataset_id='resources',
+                                file_path=str(tmp_path / '*.jsonl'),
+                                schema_file_path=os.path.join(self.test_dir, '../schemas/schema_document_types.json'),
+                                source_format='jsonl',
+                                max_load_jobs=1)
+
+        assert [content for _, _, content in bigquery_client.loads] == [b'{"doi": "10.1/1"}\n{"doi": "10.1/2"}\n']
+
+    def test_group_files(self, local_files):
+        groups = group_files(local_files, 3)
+        assert len(groups) == 3
+        assert sorted(file for group in groups for file in group) == sorted(local_files)
+        assert len(group_files(local_files, 100)) == len(local_files)
+
+    @pytest.mark.parametrize('max_concurrent_jobs', [1, 3])
+    def test_create_table_from_local_concurrency(self, bigquery_client, local_files, max_concurrent_jobs):
+        bigquery_client.overlap = max_concurrent_jobs
+
+        create_table_from_local(table_id='test_subslurm_bq_functions',
+                                project_id='subugoe-collaborative',
+                                dataset_id='resources',
+                                file_path=os.path.join(os.path.dirname(local_files[0]), '*.jsonl'),
+                                schema_file_path=os.path.join(self.test_dir, '../schemas/schema_crossref.json'),
+                                source_format='jsonl',
+                                write_disposition='WRITE_TRUNCATE',
+                                max_concurrent_jobs=max_concurrent_jobs,
+                                max_load_jobs=4)
+
+        loads = bigquery_client.loads
+        assert len(loads) == 4
+        # the appending jobs wait for each other in the fake client, so they overlap if allowed to
+        assert bigquery_client.max_in_flight <= max_concurrent_jobs
+        assert bigquery_client.max_in_flight == max_concurrent_jobs
+        assert [write_disposition for _, write_disposition, _ in loads] == ['WRITE_TRUNCATE'] + ['WRITE_APPEND'] * 3
+
+        lines = sorted(line for _, _, content in loads for line in content.splitlines())
+        assert lines == sorted(line for file in local_files for line in open(file, 'rb').read().splitlines())
+
+    def test_create_table_from_local_csv_header(self, bigquery_client, tmp_path):
+        for i in range(3):
+            (tmp_path / f'part_{i}.csv').write_bytes(b'doi\n10.1/%d\n' % i)
+
+        create_table_from_local(table_id='test_subslurm_bq_functions',
+                                project_id='subugoe-collaborative',
+                                dataset_id='resources',
+                                file_path=str(tmp_path / '*.csv'),
+                                schema_file_path=os.path.join(self.test_dir, '../schemas/schema_crossref.json'),
+                                source_format='csv',
+                                csv_skip_leading_rows=1,
+                                write_disposition='WRITE_APPEND',
+                                max_load_jobs=1)
+
+        # files with a header row can not be concatenated
+        assert len(bigquery_client.loads) == 3
+
     @pytest.mark.skip(reason='TODO')
     def test_create_table_from_local_empty(self):
         create_table_from_local(table_id='test_subslurm_bq_functions',
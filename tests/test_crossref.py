@@ -1,7 +1,63 @@
 import pytest
 import os
+import io
+import gzip
+import json
 import shutil
-from workflows.crossref import CrossrefSnapshot
+import tarfile
+import random
+import tracemalloc
+from datetime import datetime
+from workflows.crossref import CrossrefSnapshot, transform_date
+from workflows.utils import download_ranged, read_streams
+from bq_utils import PipelinedUploader
+
+
+def reference_transform_date(v):
+    # the strptime/strftime implementation transform_date has to agree with
+    v = v.get('date-parts')
+
+    if not v:
+        v = [[]]
+
+    v = v[0]
+
+    try:
+        len_arr_date_parts = len(v)
+
+        if len_arr_date_parts > 0:
+            if not len(str(v[0])) == 4:
+                v = None
+
+        if len_arr_date_parts == 1:
+            if v[0] is None:
+                v = None
+            else:
+                v = datetime.strptime('-'.join([str(v[0]), '1', '1']), '%Y-%m-%d')
+
+        elif len_arr_date_parts == 2:
+            v = datetime.strptime('-'.join([str(v[0]), str(v[1]), '1']), '%Y-%m-%d')
+
+        elif len_arr_date_parts == 3:
+            v = datetime.strptime('-'.join([str(v[0]), str(v[1]), str(v[2])]), '%Y-%m-%d')
+
+    except:
+        v = None
+
+    if v:
+        v = v.strftime('%Y-%m-%d')
+
+    return v
+
+
+def random_date_part(rng):
+    return rng.choice([rng.randint(-20, 40),
+                       rng.randint(0, 12000),
+                       rng.randint(1890, 2030),
+                       str(rng.randint(0, 40)).zfill(rng.randint(1, 3)),
+                       str(rng.randint(1000, 9999)),
+                       float(rng.randint(1, 2030)),
+                       rng.choice([None, True, False, '', ' 1', 'x'])])
 
 
 class TestCrossrefSnapshot:
@@ -60,4 +116,457 @@ class TestCrossrefSnapshot:
 
         crossref_snapshot.transform_snapshot()
 
-        assert os.path.exists(output_file)
\ No newline at end of file
+        assert os.path.exists(output_file)
+
+class TestCrossrefSnapshotOffline:
+
+    test_dir = os.path.abspath(os.path.dirname(__file__))
+
+    @pytest.fixture
+    def crossref_snapshot(self):
+        snapshot = CrossrefSnapshot(
+            download_path=os.path.join(self.test_dir, 'crossref_download'),
+            transform_path=os.path.join(self.test_dir, 'crossref_transform'),
+            snapshot_date=[2024, 7]
+        )
+        yield snapshot
+        shutil.rmtree(os.path.join(self.test_dir, 'crossref_download'), ignore_errors=True)
+        shutil.rmtree(os.path.join(self.test_dir, 'crossref_transform'), ignore_errors=True)
+
+    @staticmethod
+    def make_item(i):
+        return {'DOI': f'10.1234/{i}',
+                'URL': f'https://doi.org/10.1234/{i}',
+                'title': [f'Title {i} ' + 'x' * 1000],
+                'ISSN': ['1234-5678'],
+                'created': {'date-parts': [[2020, 1 + i % 12, 1 + i % 28]]},
+                'author': [{'given': 'Jane', 'family': 'Doe', 'ORCID': 'https://orcid.org/0000'}]}
+
+    def write_input(self, path, n_items):
+        with gzip.open(path, mode='wt', compresslevel=1, encoding='utf-8') as file:
+            file.write('{"status": "ok", "items": [\n')
+            for i in range(n_items):
+                if i:
+                    file.write(',\n')
+                json.dump(self.make_item(i), file)
+            file.write('\n], "message-type": "work-list"}')
+
+    def test_iter_items(self, crossref_snapshot):
+
+        input_file = os.path.join(self.test_dir, 'crossref_download/crossref_sample.json.gz')
+
+        self.write_input(input_file, 50)
+
+        with gzip.open(input_file, mode='r') as file:
+            expected = json.load(file)['items']
+
+        with gzip.open(input_file, mode='r') as file:
+            items = list(crossref_snapshot.iter_items(file, chunk_size=7))
+
+        assert items == expected
+
+    def test_iter_items_empty(self, crossref_snapshot):
+
+        input_file = os.path.join(self.test_dir, 'crossref_download/crossref_sample.json.gz')
+
+        with gzip.open(input_file, mode='wt') as file:
+            file.write('{"items": []}')
+
+        with gzip.open(input_file, mode='r') as file:
+            assert list(crossref_snapshot.iter_items(file)) == []
+
+    def test_transform_file_bounded_memory(self, crossref_snapshot):
+
+        input_file = os.path.join(self.test_dir, 'crossref_download/crossref_sample.json.gz')
+
+        output_file = os.path.join(self.test_dir, 'crossref_transform/crossref_sample.jsonl.gz')
+
+        n_items = 5000
+
+        self.write_input(input_file, n_items)
+
+        tracemalloc.start()
+        crossref_snapshot.transform_file(input_file, output_file)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        with gzip.open(output_file, mode='r') as file:
+            lines = file.readlines()
+
+        assert len(lines) == n_items
+        assert json.loads(lines[-1])['doi'] == f'10.1234/{n_items - 1}'
+
+        # holding the decoded input in memory peaks at about 25MB
+        assert peak < 8 * 1024 * 1024
+
+    def test_transform_item_golden(self, crossref_snapshot):
+
+        input_file = os.path.join(self.test_dir, 'test_files_crossref/crossref_sample.json.gz')
+
+        expected_file = os.path.join(self.test_dir, 'test_files_crossref/crossref_sample_transformed.jsonl.gz')
+
+        with gzip.open(input_file, mode='r') as file:
+            items = json.load(file)['items']
+
+        with gzip.open(expected_file, mode='r') as file:
+            expected = [json.loads(line) for line in file]
+
+        assert len(items) == len(expected)
+
+        for item, expected_item in zip(items, expected):
+            assert crossref_snapshot.transform_item(item) == expected_item
+
+    def test_transform_file_golden(self, crossref_snapshot):
+
+        input_file = os.path.join(self.test_dir, 'test_files_crossref/crossref_sample.json.gz')
+
+        expected_file = os.path.join(self.test_dir, 'test_files_crossref/crossref_sample_transformed.jsonl.gz')
+
+        output_file = os.path.join(self.test_dir, 'crossref_transform/crossref_sample.jsonl.gz')
+
+        crossref_snapshot.transform_file(input_file, output_file)
+
+        with gzip.open(output_file, mode='r') as file, gzip.open(expected_file, mode='r') as expected:
+            assert [json.loads(line) for line in file] == [json.loads(line) for line in expected]
+
+    def test_transform_snapshot_parquet(self, crossref_snapshot):
+        pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+
+        input_file = os.path.join(self.test_dir, 'test_files_crossref/crossref_sample.json.gz')
+
+        expected_file = os.path.join(self.test_dir, 'test_files_crossref/crossref_sample_transformed.jsonl.gz')
+
+        shutil.copyfile(input_file, os.path.join(self.test_dir, 'crossref_download/crossref_sample.json'))
+
+        crossref_snapshot.output_format = 'parquet'
+        crossref_snapshot.transform_snapshot(max_workers=2, split_size=1000)
+
+        output_file = os.path.join(self.test_dir, 'crossref_transform/crossref_sample.parquet')
+
+        assert sorted(os.listdir(os.path.join(self.test_dir, 'crossref_transform'))) == ['.manifest.jsonl',
+                                                                                          '.snapshot',
+                                                                                          'crossref_sample.parquet']
+
+        table = pyarrow_parquet.read_table(output_file)
+        assert table.schema.field('license').type.value_type.field('start').type == 'date32'
+
+        rows = {row['doi']: row for row in table.to_pylist()}
+
+        with gzip.open(expected_file, mode='r') as expected:
+            records = [json.loads(line) for line in expected]
+
+        assert sorted(rows) == sorted(record['doi'] for record in records)
+
+        for record in records:
+            row = rows[record['doi']]
+            assert row['title'] == (record['title'] or None)
+            assert [author['family'] for author in row['author'] or []] == [author['family'] for author in record['author'] or []]
+            assert (row['created'] and row['created'].isoformat()) == (record['created'] or None)
+
+    def test_transform_snapshot_storage_write(self, crossref_snapshot, directory_sink):
+        input_file = os.path.join(self.test_dir, 'test_files_crossref/crossref_sample.json.gz')
+
+        expected_file = os.path.join(self.test_dir, 'test_files_crossref/crossref_sample_transformed.jsonl.gz')
+
+        shutil.copyfile(input_file, os.path.join(self.test_dir, 'crossref_download/crossref_sample.json'))
+
+        crossref_snapshot.output_format = 'storage_write'
+        crossref_snapshot.sink = directory_sink
+        crossref_snapshot.transform_snapshot(max_workers=2, split_size=1000)
+
+        transform_path = os.path.join(self.test_dir, 'crossref_transform')
+
+        assert sorted(os.listdir(transform_path)) == ['.manifest.jsonl', '.snapshot', 'crossref_sample.streams.json']
+
+        # the part was split into two shards, each written to its own stream
+        stream_names = read_streams(transform_path)
+        assert len(stream_names) == 2
+
+        with gzip.open(expected_file, mode='r') as expected:
+            records = [json.loads(line) for line in expected]
+
+        assert sorted(row['doi'] for row in directory_sink.commit(stream_names)) == sorted(record['doi'] for record in records)
+
+        with pytest.raises(ValueError):
+            CrossrefSnapshot(download_path=os.path.join(self.test_dir, 'crossref_download'),
+                             transform_path=transform_path,
+                             snapshot_date=crossref_snapshot.snapshot_date,
+                             output_format='storage_write')
+
+    def test_reconstruct_snapshot(self, crossref_snapshot):
+
+        download_path = os.path.join(self.test_dir, 'crossref_download')
+        transform_path = os.path.join(self.test_dir, 'crossref_transform')
+
+        shutil.copyfile(os.path.join(self.test_dir, 'test_files_crossref/crossref_sample.json.gz'),
+                        os.path.join(download_path, 'crossref_sample.json'))
+
+        crossref_snapshot.transform_snapshot(max_workers=1)
+
+        # a rerun of the same snapshot keeps the downloads, outputs and manifest to resume from
+        CrossrefSnapshot(download_path=download_path, transform_path=transform_path, snapshot_date=[2024, 7])
+
+        assert os.path.exists(os.path.join(download_path, 'crossref_sample.json'))
+        assert sorted(os.listdir(transform_path)) == ['.manifest.jsonl', '.snapshot', 'crossref_sample.jsonl.gz']
+
+        CrossrefSnapshot(download_path=download_path, transform_path=transform_path, snapshot_date=[2024, 8])
+
+        assert os.listdir(download_path) == os.listdir(transform_path) == ['.snapshot']
+
+        shutil.copyfile(os.path.join(self.test_dir, 'test_files_crossref/crossref_sample.json.gz'),
+                        os.path.join(download_path, 'crossref_sample.json'))
+
+        CrossrefSnapshot(download_path=download_path, transform_path=transform_path, snapshot_date=[2024, 8], clean=True)
+
+        assert os.listdir(download_path) == ['.snapshot']
+
+    def test_output_format(self, crossref_snapshot):
+        with pytest.raises(ValueError):
+            CrossrefSnapshot(download_path=os.path.join(self.test_dir, 'crossref_download'),
+                             transform_path=os.path.join(self.test_dir, 'crossref_transform'),
+                             snapshot_date=[2024, 7],
+                             output_format='avro')
+
+    def test_transform_date(self):
+
+        assert transform_date({'date-parts': [[2020, 2, 29]]}) == '2020-02-29'
+        assert transform_date({'date-parts': [[2019, 2, 29]]}) is None
+        assert transform_date({'date-parts': [[2019, 7]]}) == '2019-07-01'
+        assert transform_date({'date-parts': [[2019]]}) == '2019-01-01'
+        assert transform_date({'date-parts': [[219, 1, 1]]}) is None
+        assert transform_date({'date-parts': [[None]]}) is None
+        assert transform_date({'date-parts': [[]]}) == []
+        assert transform_date({'date-parts': []}) == []
+        assert transform_date({}) == []
+
+    def test_transform_date_matches_reference(self):
+
+        rng = random.Random(20241018)
+
+        for _ in range(20000):
+            n_parts = rng.randint(0, 3)
+            if rng.random() < 0.7:
+                date_parts = [rng.randint(1000, 9999), rng.randint(0, 13), rng.randint(0, 32)][:n_parts]
+            else:
+                date_parts = [random_date_part(rng) for _ in range(n_parts)]
+
+            date = {'date-parts': [date_parts]}
+
+            assert transform_date(date) == reference_transform_date(date), date_parts
+
+    def test_transform_snapshot_split(self, crossref_snapshot):
+
+        input_file = os.path.join(self.test_dir, 'test_files_crossref/crossref_sample.json.gz')
+
+        expected_file = os.path.join(self.test_dir, 'test_files_crossref/crossref_sample_transformed.jsonl.gz')
+
+        shutil.copyfile(input_file, os.path.join(self.test_dir, 'crossref_download/crossref_sample.json'))
+
+        crossref_snapshot.transform_snapshot(max_workers=2, split_size=1000)
+
+        output_file = os.path.join(self.test_dir, 'crossref_transform/crossref_sample.jsonl.gz')
+
+        assert sorted(os.listdir(os.path.join(self.test_dir, 'crossref_transform'))) == ['.manifest.jsonl',
+                                                                                          '.snapshot',
+                                                                                          'crossref_sample.jsonl.gz']
+
+        with gzip.open(output_file, mode='r') as file, gzip.open(expected_file, mode='r') as expected:
+            records = sorted(json.loads(line)['doi'] for line in file)
+            assert records == sorted(json.loads(line)['doi'] for line in expected)
+
+    def test_transform_snapshot_resume(self, crossref_snapshot):
+
+        input_file = os.path.join(self.test_dir, 'test_files_crossref/crossref_sample.json.gz')
+
+        for name in ['part_a', 'part_b', 'part_c']:
+            shutil.copyfile(input_file, os.path.join(self.test_dir, f'crossref_download/{name}.json'))
+
+        crossref_snapshot.transform_snapshot(max_workers=2)
+
+        output_files = {name: os.path.join(self.test_dir, f'crossref_transform/{name}.jsonl') + '.gz'
+                        for name in ['part_a', 'part_b', 'part_c']}
+
+        mtimes = {name: os.stat(path).st_mtime_ns for name, path in output_files.items()}
+
+        with open(os.path.join(self.test_dir, 'crossref_transform/.manifest.jsonl')) as file:
+            entries = [json.loads(line) for line in file]
+
+        assert sorted(entry['output'] for entry in entries) == sorted(output_files.values())
+
+        # part_b never finished, part_c was corrupted after it was written
+        os.remove(output_files['part_b'])
+        with open(output_files['part_c'], 'ab') as file:
+            file.write(b'garbage')
+
+        crossref_snapshot.transform_snapshot(max_workers=2, resume=True)
+
+        assert os.stat(output_files['part_a']).st_mtime_ns == mtimes['part_a']
+        assert os.path.exists(output_files['part_b'])
+
+        with gzip.open(output_files['part_c'], mode='r') as file:
+            assert len(file.readlines()) == 100
+
+        assert not [name for name in os.listdir(os.path.join(self.test_dir, 'crossref_transform'))
+                    if name.endswith('.tmp')]
+
+    def test_transform_snapshot_array(self, crossref_snapshot):
+
+        input_file = os.path.join(self.test_dir, 'test_files_crossref/crossref_sample.json.gz')
+
+        names = ['part_a', 'part_b', 'part_c', 'part_d', 'part_e']
+        for name in names:
+            shutil.copyfile(input_file, os.path.join(self.test_dir, f'crossref_download/{name}.json'))
+
+        transform_path = os.path.join(self.test_dir, 'crossref_transform')
+
+        outputs = []
+        for shard_index in range(2):
+            before = set(os.listdir(transform_path))
+            crossref_snapshot.transform_snapshot(max_workers=1, shard_index=shard_index, shard_count=2)
+            outputs.append(set(os.listdir(transform_path)) - before - {f'.manifest-{shard_index}.jsonl'})
+
+        # every part is transformed by exactly one array task
+        assert not outputs[0] & outputs[1]
+        assert outputs[0] | outputs[1] == {f'{name}.jsonl.gz' for name in names}
+
+        assert crossref_snapshot.finalize(2) == 5
+        assert sorted(name for name in os.listdir(transform_path) if name.startswith('.')) == ['.manifest.jsonl', '.snapshot']
+
+    def test_transform_snapshot_pipelined_upload(self, crossref_snapshot, storage_client):
+
+        input_file = os.path.join(self.test_dir, 'test_files_crossref/crossref_sample.json.gz')
+
+        names = ['part_a', 'part_b', 'part_c']
+        for name in names:
+            shutil.copyfile(input_file, os.path.join(self.test_dir, f'crossref_download/{name}.json'))
+
+        transform_path = os.path.join(self.test_dir, 'crossref_transform')
+
+        with PipelinedUploader(bucket_name='bigschol', gcb_dir='crossref', root=transform_path) as uploader:
+            crossref_snapshot.transform_snapshot(max_workers=2, on_complete=uploader.put)
+
+        assert sorted(storage_client.objects) == [('bigschol', f'crossref/{name}.jsonl.gz') for name in names]
+
+        for name in names:
+            with open(os.path.join(transform_path, f'{name}.jsonl.gz'), 'rb') as file:
+                assert storage_client.objects['bigschol', f'crossref/{name}.jsonl.gz'] == file.read()
+
+    def test_download(self, crossref_snapshot, range_server, monkeypatch):
+
+        monkeypatch.setenv('CROSSREF_PLUS_API_TOKEN', 'token')
+
+        range_server.content = os.urandom(300000)
+
+        crossref_snapshot.SNAPSHOT_URL = range_server.url + '/snapshots/monthly/{year}/{month:02d}/all.json.tar.gz'
+
+        crossref_snapshot.download(connections=2)
+
+        with open(os.path.join(self.test_dir, 'crossref_download', crossref_snapshot.filename), 'rb') as file:
+            assert file.read() == range_server.content
+
+        path, _, headers = range_server.requests[0]
+
+        assert path == '/snapshots/monthly/2024/07/all.json.tar.gz'
+        assert headers['Crossref-Plus-API-Token'] == 'Bearer token'
+
+    def test_transform_snapshot_after_interrupted_download(self, crossref_snapshot, range_server, monkeypatch):
+
+        range_server.content = os.urandom(300000)
+        range_server.fail_ranges = {'bytes=100000-199999'}
+
+        download_path = os.path.join(self.test_dir, 'crossref_download')
+
+        with pytest.raises(IOError):
+            download_ranged(range_server.url + '/all.json',
+                            os.path.join(download_path, 'all.json'),
+                            connections=1,
+                            chunk_size=100000,
+                            retries=0)
+
+        assert sorted(os.listdir(download_path)) == ['.all.json.progress', '.snapshot', 'all.json']
+
+        planned = []
+        monkeypatch.setattr('workflows.crossref.run_transform_tasks',
+                            lambda snapshot, tasks, *args, **kwargs: planned.extend(tasks))
+
+        # the sidecar name of earlier versions
+        with open(os.path.join(download_path, 'all.json.progress'), 'w') as file:
+            file.write('{}')
+
+        crossref_snapshot.transform_snapshot(max_workers=1)
+
+        # the progress of the download is not taken for a part of the snapshot
+        assert [task.input_file_path for task in planned] == [download_path + '/all.json']
+
+    def write_tarball(self, tar_path):
+        input_file = os.path.join(self.test_dir, 'test_files_crossref/crossref_sample.json.gz')
+
+        with open(input_file, 'rb') as file:
+            data = file.read()
+
+        with tarfile.open(tar_path, mode='w:gz') as tar:
+            for name, content in [('crossref/0.json.gz', data),
+                                  ('crossref/1.json.gz', data),
+                                  ('crossref/2.json', gzip.decompress(data))]:
+                member = tarfile.TarInfo(name)
+                member.size = len(content)
+                tar.addfile(member, io.BytesIO(content))
+
+    def assert_tarball_outputs(self):
+        expected_file = os.path.join(self.test_dir, 'test_files_crossref/crossref_sample_transformed.jsonl.gz')
+
+        with gzip.open(expected_file, mode='r') as file:
+            expected = [json.loads(line) for line in file]
+
+        for name in ['0.jsonl.gz', '1.jsonl.gz', '2.jsonl.gz']:
+            with gzip.open(os.path.join(self.test_dir, 'crossref_transform', name), mode='r') as file:
+                assert [json.loads(line) for line in file] == expected
+
+    def test_transform_tarball(self, crossref_snapshot):
+
+        tar_path = os.path.join(self.test_dir, 'crossref_download', crossref_snapshot.filename)
+
+        self.write_tarball(tar_path)
+
+        crossref_snapshot.transform_tarball(tar_path, max_workers=2)
+
+        self.assert_tarball_outputs()
+
+        output_file = os.path.join(self.test_dir, 'crossref_transform/1.jsonl.gz')
+        mtime = os.stat(output_file).st_mtime_ns
+
+        crossref_snapshot.transform_tarball(tar_path, max_workers=2, resume=True)
+
+        assert os.stat(output_file).st_mtime_ns == mtime
+
+    def test_transform_tarball_duplicate_names(self, crossref_snapshot):
+
+        tar_path = os.path.join(self.test_dir, 'crossref_download', crossref_snapshot.filename)
+
+        with tarfile.open(tar_path, mode='w:gz') as tar:
+            for name in ['crossref/a/0.json', 'crossref/b/0.json']:
+                member = tarfile.TarInfo(name)
+                member.size = 2
+                tar.addfile(member, io.BytesIO(b'{}'))
+
+        # every array task fails, also the one that would only transform the second member
+        for shard_index in range(2):
+            with pytest.raises(ValueError):
+                crossref_snapshot.transform_tarball(tar_path, max_workers=1, shard_index=shard_index, shard_count=2)
+
+    def test_transform_tarball_while_downloading(self, crossref_snapshot, range_server, monkeypatch):
+
+        monkeypatch.setenv('CROSSREF_PLUS_API_TOKEN', 'token')
+
+        tar_path = os.path.join(self.test_dir, 'crossref_download', 'served.tar.gz')
+
+        self.write_tarball(tar_path)
+
+        with open(tar_path, 'rb') as file:
+            range_server.content = file.read()
+
+        crossref_snapshot.SNAPSHOT_URL = range_server.url + '/snapshots/monthly/{year}/{month:02d}/all.json.tar.gz'
+
+        crossref_snapshot.transform_tarball(max_workers=2)
+
+        self.assert_tarball_outputs()
@@ -0,0 +1,163 @@
+import pytest
+import sqlite3
+import threading
+from dag_runner import DAG, NonRetryableError, run_dags
+
+
+class TestDagRunner:
+
+    def test_run_dags_parallel(self, tmp_path):
+
+        # the upload of one DAG can only finish while the transform of the other one runs
+        barrier = threading.Barrier(2, timeout=5)
+        calls = []
+
+        crossref = DAG('crossref', '2024-07')
+
+        @crossref.task()
+        def transform():
+            calls.append('crossref.transform')
+            return ['part_a', 'part_b']
+
+        @crossref.task(deps=['transform'])
+        def upload(transform):
+            barrier.wait()
+            calls.append('crossref.upload')
+            return len(transform)
+
+        document_types = DAG('document_types', '2024-07')
+
+        @document_types.task()
+        def transform():
+            barrier.wait()
+            calls.append('document_types.transform')
+
+        states = run_dags([crossref, document_types], state_path=str(tmp_path / 'state.sqlite'))
+
+        assert states == {'crossref': {'transform': 'success', 'upload': 'success'},
+                          'document_types': {'transform': 'success'}}
+        assert sorted(calls) == ['crossref.transform', 'crossref.upload', 'document_types.transform']
+
+    def test_run_dags_retries(self, tmp_path):
+
+        attempts = []
+        dag = DAG('crossref', '2024-07')
+
+        @dag.task(retries=2, retry_delay=0)
+        def download():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise ConnectionError('Connection reset.')
+            return 'all.json.tar.gz'
+
+        states = run_dags([dag], state_path=str(tmp_path / 'state.sqlite'))
+
+        assert states == {'crossref': {'download': 'success'}}
+        assert len(attempts) == 3
+
+        with sqlite3.connect(tmp_path / 'state.sqlite') as connection:
+            assert connection.execute('SELECT state, attempts, result FROM task_runs').fetchall() == [('success', 3, '"all.json.tar.gz"')]
+
+    def test_run_dags_non_retryable(self, tmp_path):
+
+        attempts = []
+        dag = DAG('crossref', '2024-07')
+
+        @dag.task(retries=3, retry_delay=0)
+        def upload():
+            attempts.append(1)
+            raise NonRetryableError('Slurm job 1 ended with state FAILED.')
+
+        states = run_dags([dag], state_path=str(tmp_path / 'state.sqlite'))
+
+        assert states == {'crossref': {'upload': 'failed'}}
+        assert len(attempts) == 1
+
+    def test_run_dags_failure(self, tmp_path):
+
+        calls = []
+        dag = DAG('crossref', '2024-07')
+
+        @dag.task(retries=1, retry_delay=0)
+        def download():
+            calls.append('download')
+            raise ConnectionError('Connection reset.')
+
+        @dag.task(deps=['download'])
+        def transform(download):
+            calls.append('transform')
+
+        @dag.task()
+        def cleanup():
+            calls.append('cleanup')
+
+        states = run_dags([dag], state_path=str(tmp_path / 'state.sqlite'))
+
+        # independent tasks still run
+        assert states == {'crossref': {'download': 'failed', 'transform': 'upstream_failed', 'cleanup': 'success'}}
+        assert sorted(calls) == ['cleanup', 'download', 'download']
+
+    def test_run_dags_resume(self, tmp_path):
+
+        state_path = str(tmp_path / 'state.sqlite')
+        calls = []
+        fail = [True]
+
+        def build_dag(run_id):
+            dag = DAG('crossref', run_id)
+
+            @dag.task()
+            def submit():
+                calls.append('submit')
+                return [1000, 1001]
+
+            @dag.task(deps=['submit'])
+            def transform(submit):
+                calls.append(('transform', tuple(submit)))
+                if fail[0]:
+                    raise RuntimeError('Slurm jobs ended with state FAILED.')
+
+            @dag.task(deps=['transform'])
+            def upload(transform):
+                calls.append('upload')
+
+            return dag
+
+        assert run_dags([build_dag('2024-07')], state_path)['crossref']['transform'] == 'failed'
+
+        # the persisted result of submit is passed on, submit does not run again
+        fail[0] = False
+        calls.clear()
+        assert set(run_dags([build_dag('2024-07')], state_path)['crossref'].values()) == {'success'}
+        assert calls == [('transform', (1000, 1001)), 'upload']
+
+        calls.clear()
+        run_dags([build_dag('2024-07')], state_path)
+        assert calls == []
+
+        # a reset reruns the task and everything downstream of it
+        run_dags([build_dag('2024-07')], state_path, reset=['crossref.transform'])
+        assert calls == [('transform', (1000, 1001)), 'upload']
+
+        # a new run starts from scratch
+        calls.clear()
+        run_dags([build_dag('2024-08')], state_path)
+        assert calls == ['submit', ('transform', (1000, 1001)), 'upload']
+
+    def test_add_task(self):
+
+        dag = DAG('crossref', '2024-07')
+
+        with pytest.raises(ValueError):
+            @dag.task(deps=['download'])
+            def transform(download):
+                pass
+
+        @dag.task()
+        def download():
+            pass
+
+        with pytest.raises(ValueError):
+            @dag.task()
+            def download():
+                pass
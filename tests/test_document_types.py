@@ -1,7 +1,12 @@
 import pytest
 import os
+import gzip
+import json
+import pickle
 import shutil
-from workflows.document_types import OpenAlexDocumentTypesSnapshot
+import itertools
+import workflows.document_types
+from workflows.document_types import OpenAlexDocumentTypesSnapshot, may_be_selected
 
 
 class TestOpenAlexDocumentTypesSnapshot:
@@ -28,6 +33,50 @@ class TestOpenAlexDocumentTypesSnapshot:
         page_str = '101-102'
         assert openalex_snapshot.page_counter(page_str) == 2
 
+    # outputs of the former eval() based implementation
+    @pytest.mark.parametrize('page_str, page_count', [('e123-e130', 8),
+                                                      ('S12-S15', 4),
+                                                      ('A5-A9', 5),
+                                                      ('12.5-14', 3),
+                                                      ('123e4-130', 8),
+                                                      ('102-101', 2),
+                                                      ('1-1', 1),
+                                                      ('123', 1),
+                                                      ('e12', 1),
+                                                      ('5-', 1),
+                                                      ('5-None', 1),
+                                                      ('abc-def', 1),
+                                                      ('1,234-1,240', 7),
+                                                      ('1 234-1 240', 7),
+                                                      ('-5', 6),
+                                                      ('5--10', 16),
+                                                      ('12-14-15', 18),
+                                                      ('85-x', 1),
+                                                      ('', 1)])
+    def test_page_counter_golden(self, openalex_snapshot, page_str, page_count):
+        assert openalex_snapshot.page_counter(page_str) == page_count
+
+    # the only changed counts: eval() raised on roman numerals and leading zeros and counted
+    # 1 page, now these ranges are counted
+    @pytest.mark.parametrize('page_str, page_count', [('iv-xii', 9),
+                                                      ('ii-IV', 3),
+                                                      ('e0123-e0130', 8),
+                                                      ('01-05', 5)])
+    def test_page_counter_ranges(self, openalex_snapshot, page_str, page_count):
+        assert openalex_snapshot.page_counter(page_str) == page_count
+
+    def test_page_counter_fixtures(self, openalex_snapshot):
+
+        page_strs = []
+        with gzip.open(os.path.join(self.test_dir, 'test_files_openalex/updated_date=2024-07-30/openalex_sample.jsonl.gz'), 'r') as file:
+            for line in file:
+                biblio = json.loads(line).get('biblio') or {}
+                first_page, last_page = biblio.get('first_page'), biblio.get('last_page')
+                if first_page:
+                    page_strs.append(f'{first_page}-{last_page}' if last_page else str(first_page))
+
+        assert [openalex_snapshot.page_counter(page_str) for page_str in page_strs] == [7, 45, 11, 25, 13, 2, 7, 1]
+
     def test_get_label(self, openalex_snapshot):
 
         research_proba = 0.93
@@ -77,4 +126,155 @@ class TestOpenAlexDocumentTypesSnapshot:
 
         openalex_snapshot.transform_snapshot()
 
-        assert os.path.exists(output_file)
\ No newline at end of file
+        assert os.path.exists(output_file)
+
+    def test_transform_file_output(self, openalex_snapshot):
+
+        input_file = os.path.join(self.test_dir, 'test_files_openalex/updated_date=2024-07-30/openalex_sample.jsonl.gz')
+
+        output_file = os.path.join(self.test_dir, 'openalex_transform/updated_date=2024-07-30/openalex_sample.jsonl.gz')
+
+        openalex_snapshot.transform_file(input_file, output_file)
+
+        with gzip.open(output_file, 'r') as file:
+            assert [json.loads(line) for line in file] == [{'openalex_id': 'https://openalex.org/W3001897055',
+                                                            'doi': '10.1056/nejmoa2001017',
+                                                            'is_research': True,
+                                                            'proba': 0.98}]
+
+    def test_transform_records_prefilter(self, openalex_snapshot, monkeypatch):
+
+        input_file = os.path.join(self.test_dir, 'test_files_openalex/updated_date=2024-07-30/openalex_sample.jsonl.gz')
+
+        with gzip.open(input_file, 'r') as file:
+            works = [json.loads(line) for line in file]
+
+        # every combination of the filtered fields, in both JSON layouts
+        lines = []
+        for work, item_type, publication_year, source_type, separators in itertools.product(works,
+                                                                                            ['article', 'review', 'preprint'],
+                                                                                            [1999, 2013, 2014, 2020],
+                                                                                            ['journal', 'repository'],
+                                                                                            [(', ', ': '), (',', ':')]):
+            work = dict(work,
+                        type=item_type,
+                        publication_year=publication_year,
+                        primary_location={'source': {'type': source_type}})
+            lines.append(json.dumps(work, separators=separators).encode())
+
+        selected = list(openalex_snapshot.transform_records(lines))
+
+        monkeypatch.setattr(workflows.document_types, 'may_be_selected', lambda line: True)
+
+        assert selected == list(openalex_snapshot.transform_records(lines))
+        assert len(selected) == len(works) * 2 * 2 * 2
+
+    @pytest.mark.parametrize('line, expected', [(b'{"type": "article", "publication_year": 2020, "source": {"type": "journal"}}', True),
+                                                (b'{"type":"review","publication_year":2014,"source":{"type":"journal"}}', True),
+                                                (b'{"type": "article", "publication_year": 2013, "source": {"type": "journal"}}', False),
+                                                (b'{"type": "preprint", "publication_year": 2020, "source": {"type": "journal"}}', False),
+                                                (b'{"type": "article", "publication_year": 2020, "source": {"type": "repository"}}', False),
+                                                (b'{"type": "article", "title": "\\"type\\": \\"journal\\"", "publication_year": 2020}', False),
+                                                # escaped keys or values are left to the full decode
+                                                (b'{"type": "\\u0061rticle", "publication_year": 2013, "source": {"type": "journal"}}', True),
+                                                # null, floats and repeated keys are never rejected on the year
+                                                (b'{"type": "article", "publication_year": null, "source": {"type": "journal"}}', True),
+                                                (b'{"type": "article", "publication_year": 2013.5e1, "source": {"type": "journal"}}', True),
+                                                (b'{"type": "article", "publication_year": 2013, "source": {"type": "journal"}, "publication_year": 2020}', True)])
+    def test_may_be_selected(self, line, expected):
+        assert may_be_selected(line) == expected
+
+    def test_transform_file_batch_size(self, openalex_snapshot):
+
+        input_file = os.path.join(self.test_dir, 'openalex_download/openalex_sample.jsonl.gz')
+
+        with gzip.open(input_file, 'wt') as file:
+            for i in range(11):
+                file.write(json.dumps({'id': f'https://openalex.org/W{i}',
+                                       'doi': f'https://doi.org/10.1234/{i}',
+                                       'type': 'article',
+                                       'publication_year': 2020,
+                                       'primary_location': {'source': {'type': 'journal'}},
+                                       'authorships': [{}] * i,
+                                       'cited_by_count': 10 * i,
+                                       'referenced_works': ['W1'] * (3 * i),
+                                       'biblio': {'first_page': '1', 'last_page': str(i + 2),
+                                                  'issue': 'Suppl 1' if i == 3 else '1'},
+                                       'is_paratext': i == 5,
+                                       'abstract_inverted_index': {'a': [0]} if i % 2 else None,
+                                       'title': 'word ' * i,
+                                       'open_access': {'is_oa': bool(i % 3)}}) + '\n')
+
+        outputs = []
+        for batch_size in [1, 4, 50000]:
+            openalex_snapshot.batch_size = batch_size
+            output_file = os.path.join(self.test_dir, f'openalex_transform/openalex_sample_{batch_size}.jsonl.gz')
+            openalex_snapshot.transform_file(input_file, output_file)
+            with gzip.open(output_file, 'r') as file:
+                outputs.append(file.read())
+
+        assert outputs[0] == outputs[1] == outputs[2]
+
+        records = [json.loads(line) for line in outputs[0].splitlines()]
+
+        assert len(records) == 11
+        assert records[3]['proba'] == 0.0 and records[3]['is_research'] is False
+        assert records[5]['proba'] == 0.0 and records[5]['is_research'] is False
+
+    def test_transform_snapshot_split(self, openalex_snapshot):
+
+        input_file = os.path.join(self.test_dir, 'openalex_download/updated_date=2024-07-30/openalex_sample.json')
+
+        os.makedirs(os.path.dirname(input_file))
+
+        with gzip.open(input_file, 'wt') as file:
+            for i in range(30):
+                file.write(json.dumps({'id': f'https://openalex.org/W{i}',
+                                       'doi': f'https://doi.org/10.1234/{i}',
+                                       'type': 'article',
+                                       'publication_year': 2020,
+                                       'primary_location': {'source': {'type': 'journal'}},
+                                       'cited_by_count': i,
+                                       'biblio': {},
+                                       'open_access': {'is_oa': True}}) + '\n')
+
+        openalex_snapshot.transform_snapshot(max_workers=2, split_size=100)
+
+        output_file = os.path.join(self.test_dir, 'openalex_transform/updated_date=2024-07-30/openalex_sample.jsonl.gz')
+
+        with gzip.open(output_file, 'r') as file:
+            ids = sorted(json.loads(line)['openalex_id'] for line in file)
+
+        assert ids == sorted(f'https://openalex.org/W{i}' for i in range(30))
+        assert os.listdir(os.path.dirname(output_file)) == ['openalex_sample.jsonl.gz']
+
+    def test_transform_file_parquet(self, openalex_snapshot):
+        pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+
+        input_file = os.path.join(self.test_dir, 'test_files_openalex/updated_date=2024-07-30/openalex_sample.jsonl.gz')
+
+        jsonl_file = os.path.join(self.test_dir, 'openalex_transform/openalex_sample.jsonl.gz')
+
+        parquet_file = os.path.join(self.test_dir, 'openalex_transform/openalex_sample.parquet')
+
+        openalex_snapshot.transform_file(input_file, jsonl_file)
+
+        openalex_snapshot.output_format = 'parquet'
+        openalex_snapshot.transform_file(input_file, parquet_file)
+
+        with gzip.open(jsonl_file, 'r') as file:
+            expected = [json.loads(line) for line in file]
+
+        table = pyarrow_parquet.read_table(parquet_file)
+
+        assert table.schema.names == ['openalex_id', 'doi', 'is_research', 'proba']
+        assert table.to_pylist() == expected
+
+    def test_pickle(self, openalex_snapshot):
+
+        assert b'KNeighborsClassifier' not in pickle.dumps(openalex_snapshot)
+
+        snapshot = pickle.loads(pickle.dumps(openalex_snapshot))
+
+        assert snapshot.model_path == openalex_snapshot.model_path
+        assert type(snapshot.model) is type(openalex_snapshot.model)
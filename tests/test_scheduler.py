@@ -0,0 +1,182 @@
+import pytest
+import time
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from scheduler import (array_range,
+                       execute_slurm_file,
+                       get_job_info,
+                       get_job_states,
+                       get_job_status,
+                       wait_for_jobs)
+
+
+class TestScheduler:
+
+    def test_get_job_states(self, fake_slurm):
+
+        fake_slurm.set_jobs({'101': ['RUNNING'],
+                             '102': ['CANCELLED by 0'],
+                             '103_0': ['COMPLETED'],
+                             '103_1': ['RUNNING'],
+                             '104_0': ['COMPLETED'],
+                             '104_1': ['FAILED'],
+                             '999': ['COMPLETED']})
+
+        states = get_job_states([101, 102, 103, 104])
+
+        assert states == {101: 'RUNNING', 102: 'CANCELLED', 103: 'RUNNING', 104: 'FAILED'}
+
+        calls = fake_slurm.calls()
+        assert len(calls) == 1
+        assert calls[0][calls[0].index('-j') + 1] == '101,102,103,104'
+        assert '--parsable2' in calls[0] and '--noheader' in calls[0]
+
+    def test_wait_for_jobs(self, fake_slurm):
+
+        fake_slurm.set_jobs({'101': ['PENDING', 'RUNNING', 'RUNNING', 'COMPLETED'],
+                             '102': ['RUNNING', 'FAILED']})
+
+        states = wait_for_jobs([101, 102], min_interval=0.01, max_interval=0.02)
+
+        assert states == {101: 'COMPLETED', 102: 'FAILED'}
+
+        calls = fake_slurm.calls()
+        assert len(calls) == 4
+        # jobs that ended are no longer queried
+        assert [call[call.index('-j') + 1] for call in calls] == ['101,102', '101,102', '101', '101']
+
+    def test_wait_for_jobs_backoff(self, fake_slurm, monkeypatch):
+
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        monkeypatch.setattr('scheduler.time_module.sleep', sleep)
+        monkeypatch.setattr('scheduler.time_module.monotonic', lambda: now[0])
+
+        fake_slurm.set_jobs({'101': ['RUNNING'] * 5 + ['COMPLETED']})
+
+        assert wait_for_jobs([101], min_interval=5, max_interval=20) == {101: 'COMPLETED'}
+
+        assert sleeps == [5, 10, 20, 20, 20]
+        assert len(fake_slurm.calls()) == 6
+
+    def test_wait_for_jobs_timeout(self, fake_slurm):
+
+        fake_slurm.set_jobs({'101': ['RUNNING']})
+
+        start = time.monotonic()
+
+        with pytest.raises(TimeoutError):
+            wait_for_jobs([101], timeout=0.2, min_interval=0.05)
+
+        assert time.monotonic() - start < 2
+
+    def test_wait_for_jobs_marker(self, fake_slurm, tmp_path):
+
+        marker_dir = tmp_path / 'markers'
+        marker_dir.mkdir()
+
+        fake_slurm.set_jobs({'101': ['RUNNING', 'COMPLETED']})
+
+        timer = threading.Timer(0.3, lambda: (marker_dir / '101').touch())
+        timer.start()
+
+        start = time.monotonic()
+        states = wait_for_jobs([101], min_interval=10, max_interval=60, marker_dir=str(marker_dir), marker_interval=0.02)
+
+        assert states == {101: 'COMPLETED'}
+        assert time.monotonic() - start < 5
+        assert len(fake_slurm.calls()) == 2
+
+    @pytest.fixture
+    def job_states(self, monkeypatch):
+        monkeypatch.setattr('scheduler.JOB_STATES', {})
+
+    def test_get_job_status_cached(self, fake_slurm, job_states):
+
+        fake_slurm.set_jobs({'101': ['RUNNING', 'COMPLETED']})
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            statuses = list(executor.map(lambda _: get_job_status(101), range(16)))
+
+        assert statuses == ['RUNNING'] * 16
+        assert len(fake_slurm.calls()) == 1
+
+        assert get_job_status(101, ttl=0) == 'COMPLETED'
+        assert get_job_status(102, ttl=0) is None
+        assert len(fake_slurm.calls()) == 3
+
+    def test_get_job_status_parse_error(self, fake_slurm, job_states):
+
+        fake_slurm.write_command('sacct', '#!/bin/sh\necho "sacct: error: Slurm controller not responding"\n')
+
+        with pytest.raises(ValueError):
+            get_job_status(101)
+
+        fake_slurm.write_command('sacct', '#!/bin/sh\nexit 1\n')
+
+        with pytest.raises(subprocess.CalledProcessError):
+            get_job_status(101)
+
+        with pytest.raises(subprocess.CalledProcessError):
+            get_job_info(101)
+
+    def submit(self, **kwargs):
+        arguments = dict(job_name='crossref_snapshot',
+                         mail_type='ALL',
+                         mail_user='user@example.org',
+                         partition='medium',
+                         constraint='scratch',
+                         cpus_per_task=16,
+                         ntasks=1,
+                         nodes=1,
+                         mem='100GB',
+                         dependency=None,
+                         time=[0, 9, 0, 0],
+                         cmd='module load python',
+                         slurm_job='python ../workflows/crossref.py')
+        arguments.update(kwargs)
+        return execute_slurm_file(**arguments)
+
+    def test_execute_slurm_file_array(self, fake_slurm, tmp_path):
+
+        array_job_id = self.submit(array=array_range(16, 4), marker_dir=str(tmp_path))
+        job_id = self.submit(job_name='crossref_snapshot_finalize',
+                             dependency=array_job_id,
+                             slurm_job='python ../workflows/crossref.py finalize 16')
+
+        assert (array_job_id, job_id) == (1000, 1001)
+
+        scripts = fake_slurm.scripts()
+
+        assert '#SBATCH --array               0-15%4' in scripts[1000]
+        assert f"trap 'touch {tmp_path}/${{SLURM_ARRAY_JOB_ID}}_${{SLURM_ARRAY_TASK_ID}}' EXIT" in scripts[1000]
+        assert scripts[1000].rstrip().endswith('python ../workflows/crossref.py')
+
+        assert '#SBATCH --dependency          afterok:1000' in scripts[1001]
+        assert '--array' not in scripts[1001]
+        assert scripts[1001].rstrip().endswith('python ../workflows/crossref.py finalize 16')
+
+    def test_array_range(self):
+
+        assert array_range(8) == '0-7'
+        assert array_range(8, 2) == '0-7%2'
+
+    def test_wait_for_array_markers(self, fake_slurm, tmp_path):
+
+        fake_slurm.set_jobs({'1000_0': ['RUNNING', 'COMPLETED'],
+                             '1000_1': ['RUNNING', 'COMPLETED']})
+
+        (tmp_path / '1000_0').touch()
+        timer = threading.Timer(0.2, lambda: (tmp_path / '1000_1').touch())
+        timer.start()
+
+        states = wait_for_jobs([1000], min_interval=10, max_interval=60, marker_dir=str(tmp_path), marker_interval=0.02)
+
+        assert states == {1000: 'COMPLETED'}
+        assert len(fake_slurm.calls()) == 2
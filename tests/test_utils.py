@@ -0,0 +1,311 @@
+import pytest
+import io
+import os
+import gzip
+import json
+import zlib
+import datetime
+from workflows.utils import (AVAILABLE_CODECS,
+                             Manifest,
+                             ParallelGzipFile,
+                             array_task,
+                             download_ranged,
+                             follow_manifests,
+                             get_codec,
+                             merge_shards,
+                             open_output,
+                             plan_transform_tasks,
+                             select_files,
+                             shard_file_path,
+                             write_jsonl,
+                             write_parquet)
+
+
+class TestUtils:
+
+    test_dir = os.path.abspath(os.path.dirname(__file__))
+
+    records = [{'doi': '10.1234/ä', 'is_research': True, 'proba': 0.98, 'count': 2 ** 70},
+               {'doi': None, 'nested': {'list': [1, 2.5, 'x']}}]
+
+    @pytest.mark.parametrize('name', AVAILABLE_CODECS)
+    def test_codec_roundtrip(self, name):
+
+        codec = get_codec(name)
+
+        for record in self.records:
+            data = codec.dumps(record)
+            assert isinstance(data, bytes)
+            assert b'\n' not in data
+            assert json.loads(data) == record
+            assert codec.loads(data) == record
+
+    @pytest.mark.skipif('orjson' not in AVAILABLE_CODECS, reason='orjson is not installed')
+    def test_orjson_wide_integers(self):
+
+        codec = get_codec('orjson')
+
+        for data in [b'{"count": 18446744073709551617, "list": [-9223372036854775809]}',
+                     '{"count": 123456789012345678901234567890}',
+                     b'[1' + b'0' * 400 + b']',
+                     b'{"count": 18446744073709551615, "id": "W12345678901234567890123"}',
+                     # below -2**63 with only 19 digits
+                     b'[-9223372036854775809]',
+                     '{"count": -9999999999999999999}',
+                     b'[-9223372036854775808, 9999999999999999999]']:
+            record = codec.loads(data)
+            assert record == json.loads(data)
+            assert repr(record) == repr(json.loads(data))
+
+        with pytest.raises(ValueError):
+            codec.loads(b'{"count": 1')
+
+    def test_get_codec(self):
+
+        assert get_codec().name == AVAILABLE_CODECS[0]
+        assert get_codec('json').name == 'json'
+
+        with pytest.raises(ValueError):
+            get_codec('pickle')
+
+    def test_write_jsonl(self):
+
+        output_file = io.BytesIO()
+
+        write_jsonl(self.records * 5, output_file, get_codec('json'), buffer_size=100)
+
+        assert output_file.getvalue().splitlines() == [json.dumps(record, ensure_ascii=False).encode('utf-8')
+                                                       for record in self.records * 5]
+
+    @pytest.mark.parametrize('name', AVAILABLE_CODECS)
+    def test_codec_fixtures(self, name):
+
+        codec = get_codec(name)
+
+        input_file = os.path.join(self.test_dir, 'test_files_openalex/updated_date=2024-07-30/openalex_sample.jsonl.gz')
+
+        with gzip.open(input_file, 'r') as file:
+            for line in file:
+                assert codec.loads(codec.dumps(codec.loads(line))) == json.loads(line)
+
+    @pytest.mark.parametrize('compression_threads', [1, 4])
+    def test_open_output(self, tmp_path, compression_threads):
+
+        output_file = str(tmp_path / 'sample.jsonl.gz')
+
+        data = b''.join(b'{"id": %d, "title": "record %d"}\n' % (i, i * 7) for i in range(200000))
+
+        with open_output(output_file, compression_level=1, compression_threads=compression_threads) as file:
+            for start in range(0, len(data), 100000):
+                file.write(data[start:start + 100000])
+
+        with gzip.open(output_file, 'r') as file:
+            assert file.read() == data
+
+        assert zlib.decompress(open(output_file, 'rb').read(), wbits=31) == data
+
+    def test_parallel_gzip_file_empty(self, tmp_path):
+
+        output_file = str(tmp_path / 'empty.jsonl.gz')
+
+        with ParallelGzipFile(output_file, threads=2):
+            pass
+
+        with gzip.open(output_file, 'r') as file:
+            assert file.read() == b''
+
+    def test_plan_transform_tasks(self, tmp_path):
+
+        files = []
+        for name, size in [('small', 10), ('huge', 1000), ('medium', 300)]:
+            input_file = tmp_path / name
+            input_file.write_bytes(b'x' * size)
+            files.append((str(input_file), str(tmp_path / f'{name}.out')))
+
+        tasks = plan_transform_tasks(files)
+
+        assert [os.path.basename(task.input_file_path) for task in tasks] == ['huge', 'medium', 'small']
+        assert all(task.shard_count == 1 for task in tasks)
+
+        tasks = plan_transform_tasks(files, split_size=250, max_shards=3)
+
+        assert [(os.path.basename(task.input_file_path), task.shard_index) for task in tasks] == [
+            ('huge', 0), ('huge', 1), ('huge', 2), ('medium', 0), ('medium', 1), ('small', 0)]
+
+    def test_select_files(self, tmp_path):
+
+        files = []
+        for i, size in enumerate([50, 10, 40, 30, 20, 20, 5]):
+            input_file = tmp_path / f'part_{i}.json'
+            input_file.write_bytes(b'x' * size)
+            files.append((str(input_file), str(tmp_path / f'part_{i}.jsonl.gz')))
+
+        shards = [select_files(files, shard_index, 3) for shard_index in range(3)]
+
+        assert sorted(file for shard in shards for file in shard) == sorted(files)
+        assert [select_files(list(reversed(files)), shard_index, 3) for shard_index in range(3)] == shards
+        assert [sum(os.path.getsize(input_file) for input_file, _ in shard) for shard in shards] == [60, 60, 55]
+        assert select_files(files) == files
+
+    def test_array_task(self, monkeypatch):
+
+        assert array_task() == (0, 1)
+
+        monkeypatch.setenv('SLURM_ARRAY_TASK_ID', '5')
+        monkeypatch.setenv('SLURM_ARRAY_TASK_MIN', '2')
+        monkeypatch.setenv('SLURM_ARRAY_TASK_COUNT', '4')
+
+        assert array_task() == (3, 4)
+
+    def test_follow_manifests(self, tmp_path):
+
+        outputs = [str(tmp_path / f'part_{i}.jsonl.gz') for i in range(4)]
+        completed = []
+        polls = []
+
+        def is_done():
+            # two array tasks finish a part per poll, then the finalize job merges their manifests
+            poll = len(polls)
+            polls.append(poll)
+            if poll < 2:
+                Manifest(str(tmp_path / f'.manifest-{poll}.jsonl')).add('input', outputs[2 * poll], 'checksum', 1, 0.0)
+                Manifest(str(tmp_path / f'.manifest-{1 - poll}.jsonl')).add('input', outputs[2 * poll + 1], 'checksum', 1, 0.0)
+                return False
+
+            manifest = Manifest(str(tmp_path / '.manifest.jsonl'))
+            for shard_index in range(2):
+                for entry in Manifest(str(tmp_path / f'.manifest-{shard_index}.jsonl')).entries.values():
+                    manifest.add(entry['input'], entry['output'], entry['checksum'], entry['size'], entry['mtime'])
+                os.remove(tmp_path / f'.manifest-{shard_index}.jsonl')
+            return True
+
+        def on_complete(output):
+            completed.append((len(polls), output))
+
+        assert follow_manifests(str(tmp_path), on_complete, is_done, interval=0) == set(outputs)
+
+        # every output is published once, in the poll it was added in
+        assert sorted(completed) == [(1, outputs[0]), (1, outputs[1]), (2, outputs[2]), (2, outputs[3])]
+
+    def test_follow_manifests_timeout(self, tmp_path):
+
+        Manifest(str(tmp_path / '.manifest-0.jsonl')).add('input', str(tmp_path / 'part_0.jsonl.gz'), 'checksum', 1, 0.0)
+        completed = []
+
+        # a job that never leaves the queue must not keep the upload waiting forever
+        with pytest.raises(TimeoutError):
+            follow_manifests(str(tmp_path), completed.append, lambda: False, interval=0.01, timeout=0.05)
+
+        assert completed == [str(tmp_path / 'part_0.jsonl.gz')]
+
+    def test_merge_shards(self, tmp_path):
+
+        output_file = str(tmp_path / 'sample.jsonl.gz')
+
+        for shard_index in range(3):
+            with gzip.open(shard_file_path(output_file, shard_index), 'wb') as file:
+                file.write(b'shard %d\n' % shard_index)
+
+        merge_shards(output_file, 3)
+
+        with gzip.open(output_file, 'r') as file:
+            assert file.read() == b'shard 0\nshard 1\nshard 2\n'
+
+        assert os.listdir(tmp_path) == ['sample.jsonl.gz']
+
+    def test_write_parquet(self, tmp_path):
+        pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+
+        schema_file = tmp_path / 'schema.json'
+        schema_file.write_text(json.dumps([
+            {'name': 'doi', 'type': 'STRING', 'mode': 'NULLABLE'},
+            {'name': 'volume', 'type': 'INTEGER', 'mode': 'NULLABLE'},
+            {'name': 'proba', 'type': 'float', 'mode': 'NULLABLE'},
+            {'name': 'published', 'type': 'DATE', 'mode': 'NULLABLE'},
+            {'name': 'isbn', 'type': 'STRING', 'mode': 'REPEATED'},
+            {'name': 'author', 'type': 'RECORD', 'mode': 'REPEATED',
+             'fields': [{'name': 'given', 'type': 'STRING', 'mode': 'NULLABLE'}]}]))
+
+        records = [{'doi': 10, 'volume': '12', 'proba': 0.25, 'published': '2024-02-29', 'isbn': ['1', None],
+                    'author': [{'given': 'Nick', 'family': 'Haupka'}], 'unknown': 1},
+                   {'doi': None, 'published': [], 'isbn': []}] * 3
+
+        write_parquet(iter(records), str(tmp_path / 'sample.parquet'), str(schema_file), row_group_size=4)
+
+        parquet_file = pyarrow_parquet.ParquetFile(tmp_path / 'sample.parquet')
+
+        assert parquet_file.num_row_groups == 2
+        assert parquet_file.read().to_pylist()[:2] == [
+            {'doi': '10', 'volume': 12, 'proba': 0.25, 'published': datetime.date(2024, 2, 29), 'isbn': ['1'],
+             'author': [{'given': 'Nick'}]},
+            {'doi': None, 'volume': None, 'proba': None, 'published': None, 'isbn': None, 'author': None}]
+
+        for shard_index in range(2):
+            write_parquet(iter(records), shard_file_path(str(tmp_path / 'merged.parquet'), shard_index), str(schema_file))
+
+        merge_shards(str(tmp_path / 'merged.parquet'), 2)
+
+        assert pyarrow_parquet.read_table(tmp_path / 'merged.parquet').num_rows == 12
+        assert sorted(os.listdir(tmp_path)) == ['merged.parquet', 'sample.parquet', 'schema.json']
+
+    def test_download_ranged(self, tmp_path, range_server):
+
+        range_server.content = os.urandom(1000003)
+        range_server.fail_ranges = {'bytes=100000-199999'}
+
+        file_path = str(tmp_path / 'all.json.tar.gz')
+
+        throughput = download_ranged(range_server.url + '/all.json.tar.gz',
+                                     file_path,
+                                     headers={'Crossref-Plus-API-Token': 'Bearer token'},
+                                     connections=4,
+                                     chunk_size=100000,
+                                     retries=2)
+
+        with open(file_path, 'rb') as file:
+            assert file.read() == range_server.content
+
+        assert throughput > 0
+        assert sorted(os.listdir(tmp_path)) == ['all.json.tar.gz']
+        assert all(headers['Crossref-Plus-API-Token'] == 'Bearer token' for _, _, headers in range_server.requests)
+
+        # probe, eleven chunks and one retry
+        assert len(range_server.requests) == 13
+
+    def test_download_ranged_resume(self, tmp_path, range_server):
+
+        range_server.content = os.urandom(1000)
+
+        file_path = str(tmp_path / 'all.json.tar.gz')
+
+        url = range_server.url + '/all.json.tar.gz'
+
+        # an interrupted run that finished the first three chunks
+        with open(file_path, 'wb') as file:
+            file.write(range_server.content[:300] + b'\0' * 700)
+
+        with open(tmp_path / '.all.json.tar.gz.progress', 'w') as file:
+            json.dump(dict(url=url, size=1000, chunk_size=100, completed=[0, 1, 2]), file)
+
+        download_ranged(url, file_path, connections=2, chunk_size=100)
+
+        with open(file_path, 'rb') as file:
+            assert file.read() == range_server.content
+
+        requested = {range_header for _, range_header, _ in range_server.requests}
+
+        assert 'bytes=0-99' not in requested
+        assert 'bytes=300-399' in requested
+        assert len(range_server.requests) == 8
+
+    def test_download_ranged_without_range_support(self, tmp_path, range_server):
+
+        range_server.content = os.urandom(5000)
+        range_server.support_ranges = False
+
+        file_path = str(tmp_path / 'all.json.tar.gz')
+
+        download_ranged(range_server.url + '/all.json.tar.gz', file_path, chunk_size=100)
+
+        with open(file_path, 'rb') as file:
+            assert file.read() == range_server.content
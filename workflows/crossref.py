@@ -18,18 +18,168 @@
 
 
 import os
+import io
+import sys
 import json
-import gzip
 import requests
 import functools
-import shutil
+import itertools
 import pickle
+import tarfile
 import re
-from pathlib import Path
+import logging
 from bs4 import BeautifulSoup
 from datetime import datetime
-from concurrent.futures import ProcessPoolExecutor, as_completed
 from multiprocessing import cpu_count
+from workflows.utils import (OUTPUT_EXTENSIONS,
+                             array_task,
+                             download_ranged,
+                             RawReader,
+                             get_codec,
+                             manifest_name,
+                             merge_manifests,
+                             open_input,
+                             open_output,
+                             plan_transform_tasks,
+                             prepare_directory,
+                             run_tar_transform,
+                             run_transform_tasks,
+                             select_files,
+                             tar_output_name,
+                             write_jsonl,
+                             write_parquet,
+                             write_streams)
+
+
+DATE_FIELDS = ['approved',
+               'created',
+               'content-created',
+               'content-updated',
+               'deposited',
+               'indexed',
+               'issued',
+               'posted',
+               'accepted',
+               'published',
+               'published-print',
+               'published-online',
+               'role-start',
+               'role-end',
+               'updated',
+               'award-start',
+               'award-planned-end',
+               'award-end',
+               'end',
+               'start']
+
+
+def transform_first(v):
+    if isinstance(v, list) and len(v) >= 1:
+        v = v[0]
+    return v
+
+
+def transform_set(v):
+    return ','.join(list(set(v)))
+
+
+def transform_date(v):
+    v = v.get('date-parts')
+
+    if not v:
+        v = [[]]
+
+    return normalize_date(v[0])
+
+
+DAYS_IN_MONTH = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+
+def normalize_date(date_parts):
+    if type(date_parts) is list and 0 < len(date_parts) <= 3:
+        for part in date_parts:
+            if type(part) is not int:
+                break
+        else:
+            return normalize_int_date(*date_parts)
+
+    return parse_date(date_parts)
+
+
+@functools.lru_cache(maxsize=65536)
+def normalize_int_date(year: int, month: int = 1, day: int = 1):
+    # same result as the strptime round-trip in parse_date for integer date parts
+    if not 1000 <= year <= 9999 or not 1 <= month <= 12 or day < 1:
+        return None
+
+    days_in_month = DAYS_IN_MONTH[month - 1]
+    if month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+        days_in_month = 29
+
+    if day > days_in_month:
+        return None
+
+    return f'{year}-{month:02d}-{day:02d}'
+
+
+def parse_date(v):
+    # slow path for date parts that are not plain integers, e.g. strings
+    try:
+
+        len_arr_date_parts = len(v)
+
+        if len_arr_date_parts > 0:
+            if not len(str(v[0])) == 4:
+                v = None
+
+        if len_arr_date_parts == 1:
+            if v[0] is None:
+                v = None
+            else:
+                v = '-'.join([str(v[0]), '1', '1'])
+                v = datetime.strptime(v, '%Y-%m-%d')
+
+        elif len_arr_date_parts == 2:
+            v = '-'.join([str(v[0]), str(v[1]), '1'])
+            v = datetime.strptime(v, '%Y-%m-%d')
+
+        elif len_arr_date_parts == 3:
+            v = '-'.join([str(v[0]), str(v[1]), str(v[2])])
+            v = datetime.strptime(v, '%Y-%m-%d')
+
+    except:
+
+        v = None
+
+    if isinstance(v, datetime):
+        v = v.strftime('%Y-%m-%d')
+
+    elif v:
+        # more than three date parts
+        v = None
+
+    return v
+
+
+# keys that are not just renamed by replacing '-' with '_'
+KEY_NAMES = {'DOI': 'doi',
+             'URL': 'url',
+             'ISBN': 'isbn',
+             'ORCID': 'orcid',
+             'ISSN': 'issn'}
+
+
+@functools.lru_cache(maxsize=None)
+def key_name(k: str) -> str:
+    # Crossref uses a few hundred distinct keys, so each one is renamed once per process
+    return KEY_NAMES.get(k) or k.replace('-', '_')
+
+VALUE_HANDLERS = {'title': transform_first,
+                  'container-title': transform_first,
+                  'ISSN': transform_set,
+                  'archive': transform_set,
+                  'abstract': bool,
+                  **{k: transform_date for k in DATE_FIELDS}}
 
 
 class CrossrefSnapshot:
@@ -38,26 +188,54 @@ class CrossrefSnapshot:
                  download_path: str,
                  transform_path: str,
                  snapshot_date: list[int] = None,
-                 filename: str = 'crossref.json'):
+                 filename: str = 'crossref.json',
+                 json_codec: str = None,
+                 compression_level: int = 9,
+                 compression_threads: int = 1,
+                 output_format: str = 'jsonl',
+                 schema_file_path: str = None,
+                 clean: bool = False,
+                 sink=None):
+
+        if output_format not in OUTPUT_EXTENSIONS:
+            raise ValueError(f'Output format {output_format} is not implemented.')
+
+        # storage_write streams the records through sink instead of writing them to files
+        if output_format == 'storage_write' and sink is None:
+            raise ValueError('Output format storage_write requires a sink.')
 
         self.filename = filename
+        self.json_codec = json_codec
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
+        self.output_format = output_format
+        self.schema_file_path = schema_file_path or self.SCHEMA_FILE_PATH
+        self.sink = sink
         self.download_path = download_path
         self.transform_path = transform_path
 
         if not snapshot_date:
-            self.snapshot_date = self.get_latest_snapshot_date()
+            snapshot_date = self.get_latest_snapshot_date()
+
+        self.snapshot_date = snapshot_date
 
-        if Path(download_path).exists() and Path(download_path).is_dir():
-            shutil.rmtree(self.download_path)
+        # a run of the same snapshot resumes from what is already downloaded and transformed
+        prepare_directory(download_path, snapshot_date, clean)
+        prepare_directory(transform_path, snapshot_date, clean)
 
-        os.makedirs(download_path, exist_ok=False)
+    SNAPSHOT_URL = 'https://api.crossref.org/snapshots/monthly/{year}/{month:02d}/all.json.tar.gz'
 
-        if Path(transform_path).exists() and Path(transform_path).is_dir():
-            shutil.rmtree(self.transform_path)
+    READ_CHUNK_SIZE = 1024 * 1024
 
-        os.makedirs(transform_path, exist_ok=False)
+    SCHEMA_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'schemas', 'schema_crossref.json')
 
-    SNAPSHOT_URL = 'https://api.crossref.org/snapshots/monthly/{year}/{month:02d}/all.json.tar.gz'
+    @property
+    def codec(self):
+        return get_codec(self.json_codec)
+
+    @property
+    def output_extension(self) -> str:
+        return OUTPUT_EXTENSIONS[self.output_format]
 
     @property
     def api_token(self) -> str:
@@ -79,7 +257,7 @@ class CrossrefSnapshot:
 
         return [year, month]
 
-    def download(self) -> None:
+    def download(self, connections: int = 8) -> float:
 
         year, month = self.snapshot_date
 
@@ -87,32 +265,112 @@ class CrossrefSnapshot:
 
         header = {'Crossref-Plus-API-Token': f'Bearer {self.api_token}'}
 
-        with requests.get(url, headers=header, stream=True) as response:
-            with open(self.download_path + '/' + self.filename, 'wb') as file:
-                response.raw.read = functools.partial(response.raw.read, decode_content=False)
-                shutil.copyfileobj(response.raw, file)
-
-    def transform_file(self, input_file_path: str, output_file_path: str) -> None:
-
-        with gzip.open(input_file_path, mode='r') as input_file:
-            input_data = json.load(input_file)
-
-            output_data = []
-            for item in input_data['items']:
+        return download_ranged(url,
+                               self.download_path + '/' + self.filename,
+                               headers=header,
+                               connections=connections)
+
+    def transform_file(self,
+                       input_file_path: str,
+                       output_file_path: str,
+                       shard_index: int = 0,
+                       shard_count: int = 1) -> None:
+
+        with open_input(input_file_path) as input_file:
+            items = itertools.islice(self.iter_items(input_file), shard_index, None, shard_count)
+            transformed_items = (self.transform_item(item) for item in items)
+
+            if self.output_format == 'parquet':
+                write_parquet(transformed_items, output_file_path, self.schema_file_path)
+            elif self.output_format == 'storage_write':
+                write_streams(transformed_items, output_file_path, self.sink)
+            else:
+                CrossrefSnapshot.write_file(transformed_items,
+                                            output_file_path,
+                                            self.codec,
+                                            self.compression_level,
+                                            self.compression_threads)
 
-                transformed_item = self.transform_item(item)
-
-                output_data.append(transformed_item)
-
-            CrossrefSnapshot.write_file(output_data, output_file_path)
+    @staticmethod
+    def iter_items(input_file, chunk_size: int = READ_CHUNK_SIZE):
+        # walks the top-level 'items' array record by record, so only the current
+        # record and one read chunk are held in memory
+
+        reader = io.TextIOWrapper(input_file, encoding='utf-8')
+        decoder = json.JSONDecoder()
+        whitespace = re.compile(r'[ \t\n\r]*')
+
+        buffer = ''
+        pos = 0
+        eof = False
+
+        def fill():
+            nonlocal buffer, pos, eof
+            chunk = reader.read(chunk_size)
+            if not chunk:
+                eof = True
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+        def next_token() -> str:
+            nonlocal pos
+            while True:
+                pos = whitespace.match(buffer, pos).end()
+                if pos < len(buffer):
+                    return buffer[pos]
+                if eof:
+                    raise ValueError('Unexpected end of Crossref snapshot file.')
+                fill()
+
+        def decode():
+            nonlocal pos
+            next_token()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                    # a value that ends exactly at the buffer boundary may be truncated
+                    if end < len(buffer) or eof:
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill()
+
+        def expect(token: str) -> None:
+            nonlocal pos
+            if next_token() != token:
+                raise ValueError(f'Expected {token!r} in Crossref snapshot file.')
+            pos += 1
+
+        expect('{')
+
+        while next_token() != '}':
+            key = decode()
+            expect(':')
+
+            if key == 'items':
+                expect('[')
+                while next_token() != ']':
+                    yield decode()
+                    if next_token() == ',':
+                        pos += 1
+                pos += 1
+            else:
+                decode()
+
+            if next_token() == ',':
+                pos += 1
 
     @staticmethod
-    def write_file(data, output_file_path: str) -> None:
+    def write_file(data,
+                   output_file_path: str,
+                   codec=None,
+                   compression_level: int = 9,
+                   compression_threads: int = 1) -> None:
 
-        with gzip.open(output_file_path, mode='wb') as output_file:
-            result = [json.dumps(record, ensure_ascii=False).encode('utf-8') for record in data]
-            for line in result:
-                output_file.write(line + bytes('\n', encoding='utf8'))
+        with open_output(output_file_path, compression_level, compression_threads) as output_file:
+            write_jsonl(data, output_file, codec)
 
     @staticmethod
     def transform_item(item):
@@ -120,122 +378,128 @@ class CrossrefSnapshot:
             new = {}
             for k, v in item.items():
 
-                if k == 'DOI':
-                    k = 'doi'
-
-                if k == 'URL':
-                    k = 'url'
-
-                if k == 'ISBN':
-                    k = 'isbn'
-
-                if k == 'ORCID':
-                    k = 'orcid'
-
-                if k == 'title':
-                    if isinstance(v, list) and len(v) >= 1:
-                        v = v[0]
-
-                if k == 'container-title':
-                    if isinstance(v, list) and len(v) >= 1:
-                        v = v[0]
-
-                if k == 'ISSN':
-                    k = 'issn'
-                    v = ','.join(list(set(v)))
-
-                if k == 'archive':
-                    v = ','.join(list(set(v)))
-
-                if k == 'abstract':
-                    v =  bool(item.get('abstract'))
-
-                if k in ['approved',
-                         'created',
-                         'content-created',
-                         'content-updated',
-                         'deposited',
-                         'indexed',
-                         'issued',
-                         'posted',
-                         'accepted',
-                         'published',
-                         'published-print',
-                         'published-online',
-                         'role-start',
-                         'role-end',
-                         'updated',
-                         'award-start',
-                         'award-planned-end',
-                         'award-end',
-                         'end',
-                         'start']:
-
-                    v = item[k].get('date-parts')
-
-                    if not v:
-                        v = [[]]
-
-                    v = v[0]
-
-                    try:
+                handler = VALUE_HANDLERS.get(k)
+                if handler is not None:
+                    v = handler(v)
 
-                        len_arr_date_parts = len(v)
+                if isinstance(v, (dict, list)):
+                    v = CrossrefSnapshot.transform_item(v)
 
-                        if len_arr_date_parts > 0:
-                            if not len(str(v[0])) == 4:
-                                v = None
-
-                        if len_arr_date_parts == 1:
-                            if v[0] is None:
-                                v = None
-                            else:
-                                v = '-'.join([str(v[0]), '1', '1'])
-                                v = datetime.strptime(v, '%Y-%m-%d')
-
-                        elif len_arr_date_parts == 2:
-                            v = '-'.join([str(v[0]), str(v[1]), '1'])
-                            v = datetime.strptime(v, '%Y-%m-%d')
-
-                        elif len_arr_date_parts == 3:
-                            v = '-'.join([str(v[0]), str(v[1]), str(v[2])])
-                            v = datetime.strptime(v, '%Y-%m-%d')
-
-                    except:
-
-                        v = None
-
-                    if v:
-                        v = v.strftime('%Y-%m-%d')
-
-                k = k.replace('-', '_')
-
-                new[k] = CrossrefSnapshot.transform_item(v)
+                new[key_name(k)] = v
             return new
         elif isinstance(item, list):
-            return [CrossrefSnapshot.transform_item(i) for i in item]
+            # lists of plain values need no transformation and are passed through
+            for i in item:
+                if isinstance(i, (dict, list)):
+                    return [CrossrefSnapshot.transform_item(i) for i in item]
+            return item
         else:
             return item
 
-    def transform_snapshot(self, max_workers: int = cpu_count()) -> None:
+    def transform_snapshot(self,
+                           max_workers: int = cpu_count(),
+                           split_size: int = None,
+                           resume: bool = False,
+                           shard_index: int = 0,
+                           shard_count: int = 1,
+                           on_complete=None) -> None:
+
+        files = []
+        for input_file in os.listdir(self.download_path):
+            # hidden files are the snapshot marker and the progress of an interrupted download,
+            # which was written unhidden as <file>.progress by earlier versions
+            if input_file.startswith('.') or input_file.endswith(('.progress', '.progress.tmp')):
+                continue
+            if self.output_format == 'jsonl':
+                output_file_name = os.path.basename(input_file) + 'l.gz'
+            else:
+                output_file_name = tar_output_name(input_file, self.output_extension)
+            output_file_path = os.path.join(self.transform_path, output_file_name)
+            files.append((self.download_path + '/' + input_file, output_file_path))
+
+        files = select_files(files, shard_index, shard_count)
+
+        tasks = plan_transform_tasks(files, split_size=split_size, max_shards=max_workers)
+
+        run_transform_tasks(self,
+                            tasks,
+                            max_workers,
+                            manifest_path=os.path.join(self.transform_path, manifest_name(shard_index, shard_count)),
+                            resume=resume,
+                            on_complete=on_complete)
+
+    def finalize(self, shard_count: int) -> int:
+        # merges the manifests of the array tasks once all of them completed
+        return merge_manifests(self.transform_path, shard_count)
+
+    def transform_tarball(self,
+                          tar_path: str = None,
+                          max_workers: int = cpu_count(),
+                          resume: bool = False,
+                          shard_index: int = 0,
+                          shard_count: int = 1,
+                          on_complete=None) -> None:
+
+        # Reads the parts straight out of the snapshot tarball, so it never has to be
+        # extracted. Without tar_path the snapshot is streamed from the Crossref API and
+        # transformed while it downloads.
+        manifest_path = os.path.join(self.transform_path, manifest_name(shard_index, shard_count))
+
+        if tar_path:
+            with open(tar_path, 'rb') as tar_file:
+                run_tar_transform(self,
+                                  tar_file,
+                                  self.filename,
+                                  self.transform_path,
+                                  max_workers,
+                                  manifest_path,
+                                  resume,
+                                  shard_index,
+                                  shard_count,
+                                  on_complete)
+
+        else:
+            year, month = self.snapshot_date
 
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            futures = []
+            url = self.SNAPSHOT_URL.format(year=year, month=month)
 
-            for input_file in os.listdir(self.download_path):
-                output_file_path = os.path.join(self.transform_path,
-                                                os.path.basename(input_file) + 'l.gz')
-                future = executor.submit(self.transform_file,
-                                         input_file_path=self.download_path + '/' + input_file,
-                                         output_file_path=output_file_path)
-                futures.append(future)
+            header = {'Crossref-Plus-API-Token': f'Bearer {self.api_token}'}
 
-            for future in as_completed(futures):
-                future.result()
+            with requests.get(url, headers=header, stream=True) as response:
+                response.raise_for_status()
+                run_tar_transform(self,
+                                  RawReader(response.raw),
+                                  self.filename,
+                                  self.transform_path,
+                                  max_workers,
+                                  manifest_path,
+                                  resume,
+                                  shard_index,
+                                  shard_count,
+                                  on_complete)
 
 
 if __name__ == '__main__':
 
+    logging.basicConfig(level=logging.INFO)
+
     with open('/scratch/users/haupka/crossref_snapshot.pkl', 'rb') as inp:
         crossref_snapshot = pickle.load(inp)
-        crossref_snapshot.transform_snapshot()
+
+        tar_path = os.path.join(crossref_snapshot.download_path, crossref_snapshot.filename)
+
+        # run as a Slurm job array, every task transforms its own shard of the parts
+        shard_index, shard_count = array_task()
+
+        if len(sys.argv) > 2 and sys.argv[1] == 'finalize':
+            n_parts = crossref_snapshot.finalize(int(sys.argv[2]))
+            logging.info(f'{n_parts} parts transformed.')
+        elif os.path.isfile(tar_path) and tarfile.is_tarfile(tar_path):
+            crossref_snapshot.transform_tarball(tar_path,
+                                                resume=True,
+                                                shard_index=shard_index,
+                                                shard_count=shard_count)
+        else:
+            crossref_snapshot.transform_snapshot(resume=True,
+                                                 shard_index=shard_index,
+                                                 shard_count=shard_count)
@@ -1,12 +1,106 @@
 import os
-import json
+import sys
 import gzip
 import pickle
-from pathlib import Path
-import shutil
 import re
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import logging
+import functools
+import itertools
+import numpy as np
 from multiprocessing import cpu_count
+from workflows.utils import (OUTPUT_EXTENSIONS,
+                             array_task,
+                             get_codec,
+                             manifest_name,
+                             merge_manifests,
+                             open_output,
+                             plan_transform_tasks,
+                             prepare_directory,
+                             run_transform_tasks,
+                             select_files,
+                             tar_output_name,
+                             write_jsonl,
+                             write_parquet,
+                             write_streams)
+
+
+ROMAN_NUMERAL_PATTERN = re.compile(r'(?=[MDCLXVI])M{0,4}(CM|CD|D?C{0,3})(XC|XL|L?X{0,3})(IX|IV|V?I{0,3})', re.IGNORECASE)
+
+ROMAN_VALUES = {'I': 1, 'V': 5, 'X': 10, 'L': 50, 'C': 100, 'D': 500, 'M': 1000}
+
+
+def roman_to_int(numeral: str) -> int:
+    numeral = numeral.upper()
+    value = 0
+    for digit, next_digit in zip(numeral, numeral[1:] + 'I'):
+        if ROMAN_VALUES[digit] < ROMAN_VALUES[next_digit]:
+            value -= ROMAN_VALUES[digit]
+        else:
+            value += ROMAN_VALUES[digit]
+    return value
+
+
+# the steps of the former eval() based page counter: the suffixes of e.g. 'e1010.e87', '12.5'
+# and '123e4' are dropped, then every character except digits and dashes
+PAGE_SUFFIX_PATTERNS = [re.compile(r'(\.e)[\d]*'), re.compile(r'(\.)[\d]*'), re.compile(r'(?<=\d)(e)(\d)*')]
+NON_RANGE_PATTERN = re.compile(r'[^\d-]')
+
+# what eval() accepted of the rest: numbers joined by dashes, a dash after a number subtracts
+# and every further dash negates, e.g. '5--10' is 5 - (-10)
+PAGE_EXPRESSION_PATTERN = re.compile(r'-*\d+(?:-+\d+)*')
+PAGE_TERM_PATTERN = re.compile(r'(-*)(\d+)')
+
+
+def page_difference(page_str: str, leading_zeros: bool = False):
+    # value of the page string as eval() computed it, None where eval() raised; with
+    # leading_zeros also for numbers like '05', on which eval() raised
+    for pattern in PAGE_SUFFIX_PATTERNS:
+        page_str = pattern.sub('', page_str)
+    expression = NON_RANGE_PATTERN.sub('', page_str)
+
+    if not PAGE_EXPRESSION_PATTERN.fullmatch(expression):
+        return None
+
+    value = 0
+    for dashes, digits in PAGE_TERM_PATTERN.findall(expression):
+        # Python integer literals have no leading zeros, e.g. '05', only 0 itself may repeat
+        if not leading_zeros and digits[0] == '0' and digits.strip('0'):
+            return None
+        value += -int(digits) if len(dashes) % 2 else int(digits)
+
+    return value
+
+
+# Patterns of the raw-line prefilter. The key and value tokens are ASCII, so they can only
+# be written differently with escapes like \u0061 for 'a'; lines with such escapes are
+# always decoded. Inside strings quotes are escaped, so the patterns match real keys only.
+JOURNAL_TYPE_PATTERN = re.compile(rb'"type"\s*:\s*"journal"')
+WORK_TYPE_PATTERN = re.compile(rb'"type"\s*:\s*"(?:article|review)"')
+PUBLICATION_YEAR_PATTERN = re.compile(rb'"publication_year"\s*:\s*(-?\d+)\s*[,}]')
+ASCII_ESCAPE_PATTERN = re.compile(rb'\\u00[0-7]')
+
+
+def may_be_selected(line: bytes) -> bool:
+    # False only for works that certainly fail the filter of transform_records: published
+    # before 2014, without a journal source type or without article or review type. The
+    # cheap substring tests run first, the patterns stop at their first match.
+    if b'\\u00' in line and ASCII_ESCAPE_PATTERN.search(line):
+        return True
+
+    # the work is rejected on its year only if every occurrence of the key is an integer
+    occurrences = line.count(b'"publication_year"')
+    if occurrences:
+        years = [int(match.group(1)) for match in itertools.islice(PUBLICATION_YEAR_PATTERN.finditer(line), occurrences)]
+        if len(years) == occurrences and max(years) < 2014:
+            return False
+
+    if b'"journal"' not in line or not JOURNAL_TYPE_PATTERN.search(line):
+        return False
+
+    if (b'"article"' not in line and b'"review"' not in line) or not WORK_TYPE_PATTERN.search(line):
+        return False
+
+    return True
 
 
 class OpenAlexDocumentTypesSnapshot:
@@ -15,43 +109,104 @@ class OpenAlexDocumentTypesSnapshot:
                  model_path: str,
                  download_path: str,
                  transform_path: str,
-                 snapshot_date: list[int] = None):
+                 snapshot_date: list[int] = None,
+                 batch_size: int = 50000,
+                 json_codec: str = None,
+                 compression_level: int = 9,
+                 compression_threads: int = 1,
+                 output_format: str = 'jsonl',
+                 schema_file_path: str = None,
+                 clean: bool = False,
+                 sink=None):
+
+        if output_format not in OUTPUT_EXTENSIONS:
+            raise ValueError(f'Output format {output_format} is not implemented.')
+
+        # storage_write streams the records through sink instead of writing them to files
+        if output_format == 'storage_write' and sink is None:
+            raise ValueError('Output format storage_write requires a sink.')
 
         self.model_path = model_path
         self.download_path = download_path
         self.transform_path = transform_path
         self.snapshot_date = snapshot_date
+        self.batch_size = batch_size
+        self.json_codec = json_codec
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
+        self.output_format = output_format
+        self.schema_file_path = schema_file_path or self.SCHEMA_FILE_PATH
+        self.sink = sink
+
+        # a run of the same snapshot resumes from what is already transformed
+        prepare_directory(download_path, snapshot_date, clean)
+        prepare_directory(transform_path, snapshot_date, clean)
+
+        self.model = self.load_model(self.model_path)
+
+    def __getstate__(self):
+        # the model is reloaded from model_path on unpickling instead of being pickled
+        state = self.__dict__.copy()
+        state.pop('model', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.model = self.load_model(self.model_path)
 
-        if Path(download_path).exists() and Path(download_path).is_dir():
-            shutil.rmtree(self.download_path)
+    @staticmethod
+    def load_model(model_path: str):
+        with open(model_path, 'rb') as model_file:
+            model = pickle.load(model_file)
+        return model
 
-        os.makedirs(download_path, exist_ok=False)
+    SNAPSHOT_URL = 's3://openalex'
 
-        if Path(transform_path).exists() and Path(transform_path).is_dir():
-            shutil.rmtree(self.transform_path)
+    FEATURES = ['author_count',
+                'has_license',
+                'is_referenced_by_count',
+                'references_count',
+                'has_funder',
+                'page_count',
+                'has_abstract',
+                'title_word_length',
+                'inst_count',
+                'has_oa_url']
 
-        os.makedirs(transform_path, exist_ok=False)
+    SCHEMA_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'schemas', 'schema_document_types.json')
 
-        self.model_file = open(self.model_path, 'rb')
-        self.model = pickle.load(self.model_file)
+    @property
+    def codec(self):
+        return get_codec(self.json_codec)
 
-    SNAPSHOT_URL = 's3://openalex'
+    @property
+    def output_extension(self) -> str:
+        return OUTPUT_EXTENSIONS[self.output_format]
 
     @staticmethod
+    @functools.lru_cache(maxsize=65536)
     def page_counter(page_str: str) -> int:
-        page_int = 1
-        if '-' in str(page_str):
-            try:
-                page_str = re.sub(r'(\.e)[\d]*', '', page_str)
-                page_str = re.sub(r'(\.)[\d]*', '', page_str)
-                page_str = re.sub(r'(?<=\d)(e)(\d)*', '', page_str)
-                page_str = re.sub(r'[^\d-]', '', page_str)
-                page_int = int(abs(eval(page_str)))
-                page_int += 1
-            except:
-                pass
-
-        return page_int
+        # number of pages of a range 'first-last', 1 if it is no range or cannot be parsed.
+        # Page strings repeat a lot across works, so their counts are cached. The counts of
+        # the former eval() based counter are kept, as the classifier was trained on them.
+        first, dash, last = str(page_str).partition('-')
+        if not dash:
+            return 1
+
+        difference = page_difference(str(page_str))
+        if difference is None:
+            # eval() failed on these and counted 1 page, e.g. 'e0123-e0130' or 'iv-xii'
+            difference = page_difference(str(page_str), leading_zeros=True)
+
+        if difference is None:
+            first, last = first.strip(), last.strip()
+            if ROMAN_NUMERAL_PATTERN.fullmatch(first) and ROMAN_NUMERAL_PATTERN.fullmatch(last):
+                difference = roman_to_int(last) - roman_to_int(first)
+
+        if difference is None:
+            return 1
+
+        return abs(difference) + 1
 
     @staticmethod
     def get_label(proba: float) -> bool:
@@ -62,134 +217,206 @@ class OpenAlexDocumentTypesSnapshot:
             label = False # 'editorial_discourse'
             return label
 
-    def transform_file(self, input_file_path: str, output_file_path: str) -> None:
-        new_data = []
+    def transform_file(self,
+                       input_file_path: str,
+                       output_file_path: str,
+                       shard_index: int = 0,
+                       shard_count: int = 1) -> None:
 
         with gzip.open(input_file_path, 'r') as file:
-            for line in file:
-
-                new_item = json.loads(line)
-                if isinstance(new_item, dict):
-
-                    source_type = None
-
-                    primary_location = new_item.get('primary_location')
-                    if primary_location:
-                        source = primary_location.get('source')
-                        if source:
-                            source_type = source.get('type')
-
-                    item_type = new_item.get('type')
-                    publication_year = new_item.get('publication_year')
-
-
-                    if source_type == 'journal' and item_type in ['article', 'review'] and publication_year >= 2014:
-
-                        doi = new_item.get('doi')
-                        openalex_id = new_item.get('id')
-                        authors = new_item.get('authorships')
-                        has_license = bool(new_item.get('license'))
-                        is_referenced_by_count = new_item.get('cited_by_count')
-                        references_works = new_item.get('referenced_works')
-                        has_funder = bool(new_item.get('grants'))
-                        first_page = new_item.get('biblio').get('first_page')
-                        last_page = new_item.get('biblio').get('last_page')
-                        issue = new_item.get('biblio').get('issue')
-                        is_paratext = bool(new_item.get('is_paratext'))
-                        has_abstract = bool(new_item.get('abstract_inverted_index'))
-                        title = new_item.get('title')
-                        inst_count = new_item.get('institutions_distinct_count')
-                        has_oa_url = bool(new_item.get('open_access').get('is_oa'))
-
-                        if doi:
-                            doi = doi.lstrip('https://doi.org/')
-
-                        if authors:
-                            author_count = len(authors)
-                        else:
-                            author_count = 0
-
-                        if references_works:
-                            references_count = len(references_works)
-                        else:
-                            references_count = 0
-
-                        if first_page:
-                            if last_page:
-                                page_count = self.page_counter(str(first_page) + '-' + str(last_page))
-                            else:
-                                page_count = self.page_counter(str(first_page))
+            lines = itertools.islice(file, shard_index, None, shard_count)
+
+            if self.output_format == 'parquet':
+                write_parquet(self.transform_records(lines), output_file_path, self.schema_file_path)
+            elif self.output_format == 'storage_write':
+                write_streams(self.transform_records(lines), output_file_path, self.sink)
+            else:
+                self.write_file(self.transform_records(lines),
+                                output_file_path,
+                                self.codec,
+                                self.compression_level,
+                                self.compression_threads)
+
+    def transform_records(self, lines):
+        loads = self.codec.loads
+        features = np.empty((self.batch_size, len(self.FEATURES)), dtype=np.int64)
+        is_overridden = np.empty(self.batch_size, dtype=bool)
+        identifiers = []
+
+        for line in lines:
+
+            # most works are rejected without decoding them
+            if isinstance(line, bytes) and not may_be_selected(line):
+                continue
+
+            new_item = loads(line)
+            if isinstance(new_item, dict):
+
+                source_type = None
+
+                primary_location = new_item.get('primary_location')
+                if primary_location:
+                    source = primary_location.get('source')
+                    if source:
+                        source_type = source.get('type')
+
+                item_type = new_item.get('type')
+                publication_year = new_item.get('publication_year')
+
+
+                if source_type == 'journal' and item_type in ['article', 'review'] and publication_year >= 2014:
+
+                    doi = new_item.get('doi')
+                    openalex_id = new_item.get('id')
+                    authors = new_item.get('authorships')
+                    has_license = bool(new_item.get('license'))
+                    is_referenced_by_count = new_item.get('cited_by_count')
+                    references_works = new_item.get('referenced_works')
+                    has_funder = bool(new_item.get('grants'))
+                    first_page = new_item.get('biblio').get('first_page')
+                    last_page = new_item.get('biblio').get('last_page')
+                    issue = new_item.get('biblio').get('issue')
+                    is_paratext = bool(new_item.get('is_paratext'))
+                    has_abstract = bool(new_item.get('abstract_inverted_index'))
+                    title = new_item.get('title')
+                    inst_count = new_item.get('institutions_distinct_count')
+                    has_oa_url = bool(new_item.get('open_access').get('is_oa'))
+
+                    if doi:
+                        doi = doi.lstrip('https://doi.org/')
+
+                    if authors:
+                        author_count = len(authors)
+                    else:
+                        author_count = 0
+
+                    if references_works:
+                        references_count = len(references_works)
+                    else:
+                        references_count = 0
+
+                    if first_page:
+                        if last_page:
+                            page_count = self.page_counter(str(first_page) + '-' + str(last_page))
                         else:
-                            page_count = 1
+                            page_count = self.page_counter(str(first_page))
+                    else:
+                        page_count = 1
 
-                        if title:
-                            title_word_length = len(title.split())
-                        else:
-                            title_word_length = 0
-
-                        if not inst_count:
-                            inst_count = 0
+                    if title:
+                        title_word_length = len(title.split())
+                    else:
+                        title_word_length = 0
 
-                        probas = self.model.predict_proba([[int(author_count),
-                                                       int(has_license),
-                                                       int(is_referenced_by_count),
-                                                       int(references_count),
-                                                       int(has_funder),
-                                                       int(page_count),
-                                                       int(has_abstract),
-                                                       int(title_word_length),
-                                                       int(inst_count),
-                                                       int(has_oa_url)]])
+                    if not inst_count:
+                        inst_count = 0
 
-                        proba = probas[:, 1][0]
+                    row = len(identifiers)
 
-                        if issue:
-                            issue = str(issue)
-                            # credits to https://compareopenalexanddimensions.streamlit.app
-                            if 'sup' in issue.lower() or 'meet' in issue.lower():
-                                proba = 0.0
+                    features[row] = [int(author_count),
+                                     int(has_license),
+                                     int(is_referenced_by_count),
+                                     int(references_count),
+                                     int(has_funder),
+                                     int(page_count),
+                                     int(has_abstract),
+                                     int(title_word_length),
+                                     int(inst_count),
+                                     int(has_oa_url)]
 
-                        if is_paratext:
-                            proba = 0.0
+                    is_overridden[row] = is_paratext
 
-                        label = self.get_label(proba)
+                    if issue:
+                        issue = str(issue)
+                        # credits to https://compareopenalexanddimensions.streamlit.app
+                        if 'sup' in issue.lower() or 'meet' in issue.lower():
+                            is_overridden[row] = True
 
-                        new_data.append(dict(openalex_id=openalex_id,
-                                             doi=doi,
-                                             is_research=label,
-                                             proba=proba))
+                    identifiers.append((openalex_id, doi))
 
-            self.write_file(new_data, output_file_path)
+                    if len(identifiers) == self.batch_size:
+                        yield from self.predict_batch(features, is_overridden, identifiers)
+                        identifiers = []
 
-    @staticmethod
-    def write_file(data, output_file_path: str) -> None:
+        if identifiers:
+            yield from self.predict_batch(features[:len(identifiers)],
+                                          is_overridden[:len(identifiers)],
+                                          identifiers)
 
-        with gzip.open(output_file_path, mode='wb') as output_file:
-            result = [json.dumps(record, ensure_ascii=False).encode('utf-8') for record in data]
-            for line in result:
-                output_file.write(line + bytes('\n', encoding='utf8'))
+    def predict_batch(self, features, is_overridden, identifiers):
+        probas = self.model.predict_proba(features)[:, 1]
 
-    def transform_snapshot(self, max_workers: int = cpu_count()) -> None:
+        # supplement/meeting issues and paratext are never research
+        probas[is_overridden] = 0.0
 
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            futures = []
+        labels = probas >= 0.5
 
-            for directory in os.listdir(self.download_path):
-                if os.path.isdir(self.download_path + '/' + directory):
-                    os.makedirs(self.transform_path + '/' + directory, exist_ok=True)
-                    for input_file in os.listdir(self.download_path + '/' + directory):
-                        output_file_path = os.path.join(self.transform_path + '/' + directory + '/' + os.path.basename(input_file) + 'l.gz')
-                        future = executor.submit(self.transform_file,
-                                                 input_file_path=self.download_path + '/' + directory + '/' + input_file,
-                                                 output_file_path=output_file_path)
-                        futures.append(future)
-
-            for future in as_completed(futures):
-                future.result()
+        for (openalex_id, doi), proba, label in zip(identifiers, probas.tolist(), labels.tolist()):
+            yield dict(openalex_id=openalex_id,
+                       doi=doi,
+                       is_research=label,
+                       proba=proba)
 
+    @staticmethod
+    def write_file(data,
+                   output_file_path: str,
+                   codec=None,
+                   compression_level: int = 9,
+                   compression_threads: int = 1) -> None:
+
+        with open_output(output_file_path, compression_level, compression_threads) as output_file:
+            write_jsonl(data, output_file, codec)
+
+    def transform_snapshot(self,
+                           max_workers: int = cpu_count(),
+                           split_size: int = None,
+                           resume: bool = False,
+                           shard_index: int = 0,
+                           shard_count: int = 1,
+                           on_complete=None) -> None:
+
+        files = []
+        for directory in os.listdir(self.download_path):
+            if os.path.isdir(self.download_path + '/' + directory):
+                os.makedirs(self.transform_path + '/' + directory, exist_ok=True)
+                for input_file in os.listdir(self.download_path + '/' + directory):
+                    if self.output_format == 'jsonl':
+                        output_file_name = os.path.basename(input_file) + 'l.gz'
+                    else:
+                        output_file_name = tar_output_name(input_file, self.output_extension)
+                    output_file_path = os.path.join(self.transform_path + '/' + directory + '/' + output_file_name)
+                    files.append((self.download_path + '/' + directory + '/' + input_file, output_file_path))
+
+        files = select_files(files, shard_index, shard_count)
+
+        tasks = plan_transform_tasks(files, split_size=split_size, max_shards=max_workers)
+
+        run_transform_tasks(self,
+                            tasks,
+                            max_workers,
+                            manifest_path=os.path.join(self.transform_path, manifest_name(shard_index, shard_count)),
+                            resume=resume,
+                            on_complete=on_complete)
+
+    def finalize(self, shard_count: int) -> int:
+        # merges the manifests of the array tasks once all of them completed
+        return merge_manifests(self.transform_path, shard_count)
 
 if __name__ == '__main__':
 
+    logging.basicConfig(level=logging.INFO)
+
     with open('/scratch/users/haupka/document_type_snapshot.pkl', 'rb') as inp:
         openalex_works_snapshot = pickle.load(inp)
-        openalex_works_snapshot.transform_snapshot()
\ No newline at end of file
+
+        # run as a Slurm job array, every task transforms its own shard of the parts
+        shard_index, shard_count = array_task()
+
+        if len(sys.argv) > 2 and sys.argv[1] == 'finalize':
+            n_parts = openalex_works_snapshot.finalize(int(sys.argv[2]))
+            logging.info(f'{n_parts} parts transformed.')
+        else:
+            # a requeued or timed out task only transforms the parts it did not finish
+            openalex_works_snapshot.transform_snapshot(resume=True,
+                                                       shard_index=shard_index,
+                                                       shard_count=shard_count)
\ No newline at end of file
@@ -0,0 +1,1081 @@
+import os
+import io
+import json
+import gzip
+import time
+import math
+import hashlib
+import zlib
+import struct
+import shutil
+import tarfile
+import logging
+import datetime
+import functools
+import threading
+import requests
+from collections import Counter, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class JsonCodec:
+
+    name = 'json'
+
+    @staticmethod
+    def dumps(record) -> bytes:
+        return json.dumps(record, ensure_ascii=False).encode('utf-8')
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+
+# every digit mapped to 0, so that a run of 20 digits, or a minus followed by 19 digits
+# (below -2**63), is found with a substring search
+DIGITS = bytes.maketrans(b'123456789', b'000000000')
+DIGITS_STR = str.maketrans('123456789', '000000000')
+WIDE_INTEGER = b'0' * 20
+WIDE_INTEGER_STR = '0' * 20
+WIDE_NEGATIVE_INTEGER = b'-' + b'0' * 19
+WIDE_NEGATIVE_INTEGER_STR = '-' + '0' * 19
+
+
+class OrjsonCodec(JsonCodec):
+
+    name = 'orjson'
+
+    @staticmethod
+    def dumps(record) -> bytes:
+        try:
+            return orjson.dumps(record)
+        except TypeError:
+            # e.g. integers beyond 64 bit, which orjson refuses to encode
+            return JsonCodec.dumps(record)
+
+    @staticmethod
+    def loads(data):
+        # orjson reads integers beyond 64 bit as floats and refuses even wider ones, json
+        # keeps them exact. Their digits are looked for cheaply first: 20 or more in a row,
+        # or 19 after a minus, as integers below -2**63 have only 19 digits.
+        if isinstance(data, str):
+            text = data.translate(DIGITS_STR)
+            wide = WIDE_INTEGER_STR in text or WIDE_NEGATIVE_INTEGER_STR in text
+        else:
+            text = bytes(data).translate(DIGITS)
+            wide = WIDE_INTEGER in text or WIDE_NEGATIVE_INTEGER in text
+
+        if wide:
+            return JsonCodec.loads(data)
+
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # e.g. numbers beyond the range of a double
+            return JsonCodec.loads(data)
+
+
+class UjsonCodec(JsonCodec):
+
+    name = 'ujson'
+
+    @staticmethod
+    def dumps(record) -> bytes:
+        return ujson.dumps(record, ensure_ascii=False).encode('utf-8')
+
+    @staticmethod
+    def loads(data):
+        return ujson.loads(data)
+
+
+CODECS = {'orjson': OrjsonCodec,
+          'ujson': UjsonCodec,
+          'json': JsonCodec}
+
+AVAILABLE_CODECS = [name for name, module in [('orjson', orjson), ('ujson', ujson), ('json', json)] if module]
+
+
+def get_codec(name: str = None) -> JsonCodec:
+    if name is None:
+        name = AVAILABLE_CODECS[0]
+
+    if name not in CODECS:
+        raise ValueError('JSON codec {0} is not implemented.'.format(name))
+
+    if name not in AVAILABLE_CODECS:
+        raise ValueError('JSON codec {0} is not installed.'.format(name))
+
+    return CODECS[name]()
+
+
+def write_jsonl(records, output_file, codec: JsonCodec = None, buffer_size: int = 256 * 1024) -> None:
+    # encoded records are written in batches of about buffer_size bytes
+    if codec is None:
+        codec = get_codec()
+
+    dumps = codec.dumps
+
+    batch = []
+    batch_size = 0
+    for record in records:
+        line = dumps(record)
+        batch.append(line)
+        batch.append(b'\n')
+        batch_size += len(line) + 1
+
+        if batch_size >= buffer_size:
+            output_file.write(b''.join(batch))
+            batch = []
+            batch_size = 0
+
+    if batch:
+        output_file.write(b''.join(batch))
+
+
+def compress_block(data: bytes, compression_level: int) -> bytes:
+    # raw deflate ending on a byte boundary, so blocks can be concatenated
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+# Write-only gzip file whose blocks are compressed by a pool of threads. The blocks
+# are compressed independently and joined into a single gzip member, so the output
+# is readable by any gzip decoder. zlib releases the GIL while compressing.
+class ParallelGzipFile:
+
+    def __init__(self,
+                 output_file_path: str,
+                 compression_level: int = 9,
+                 threads: int = 4,
+                 block_size: int = 1024 * 1024):
+
+        self.compression_level = compression_level
+        self.block_size = block_size
+        self.max_pending = 2 * threads
+
+        self.file = open(output_file_path, 'wb')
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = deque()
+        self.buffer = []
+        self.buffer_size = 0
+        self.crc = 0
+        self.size = 0
+
+        # gzip header: magic, deflate, no flags, mtime, no extra flags, unknown os
+        self.file.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) + b'\x00\xff')
+
+    def write(self, data: bytes) -> int:
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+
+        if self.buffer_size >= self.block_size:
+            self.submit_block()
+
+        return len(data)
+
+    def submit_block(self) -> None:
+        block = b''.join(self.buffer)
+        self.buffer = []
+        self.buffer_size = 0
+
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(self.executor.submit(compress_block, block, self.compression_level))
+
+        while len(self.pending) > self.max_pending:
+            self.file.write(self.pending.popleft().result())
+
+    def close(self) -> None:
+        if self.file.closed:
+            return
+
+        try:
+            if self.buffer:
+                self.submit_block()
+
+            while self.pending:
+                self.file.write(self.pending.popleft().result())
+
+            # empty final deflate block, then crc and size trailer
+            self.file.write(zlib.compressobj(self.compression_level, zlib.DEFLATED, -zlib.MAX_WBITS).flush())
+            self.file.write(struct.pack('<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+        finally:
+            self.executor.shutdown(wait=True)
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_output(output_file_path: str, compression_level: int = 9, compression_threads: int = 1):
+    if compression_threads > 1:
+        return ParallelGzipFile(output_file_path,
+                                compression_level=compression_level,
+                                threads=compression_threads)
+
+    return gzip.open(output_file_path, mode='wb', compresslevel=compression_level)
+
+
+# storage_write outputs only list the Storage Write API streams the records of a part were written to
+OUTPUT_EXTENSIONS = {'jsonl': '.jsonl.gz',
+                     'parquet': '.parquet',
+                     'storage_write': '.streams.json'}
+
+
+def require_pyarrow() -> None:
+    if pyarrow is None:
+        raise ImportError('pyarrow is required for the parquet output format.')
+
+
+def arrow_type(field: dict):
+    field_type = field['type'].upper()
+
+    if field_type in ('RECORD', 'STRUCT'):
+        value_type = pyarrow.struct([arrow_field(nested_field) for nested_field in field['fields']])
+    elif field_type == 'STRING':
+        value_type = pyarrow.string()
+    elif field_type in ('INTEGER', 'INT64'):
+        value_type = pyarrow.int64()
+    elif field_type in ('FLOAT', 'FLOAT64'):
+        value_type = pyarrow.float64()
+    elif field_type in ('BOOLEAN', 'BOOL'):
+        value_type = pyarrow.bool_()
+    elif field_type == 'DATE':
+        value_type = pyarrow.date32()
+    else:
+        raise ValueError(f'Field type {field["type"]} is not implemented for parquet.')
+
+    if field.get('mode', 'NULLABLE').upper() == 'REPEATED':
+        value_type = pyarrow.list_(value_type)
+
+    return value_type
+
+
+def arrow_field(field: dict):
+    return pyarrow.field(field['name'], arrow_type(field))
+
+
+# types whose values are written in their canonical string form, as BigQuery accepts them
+STRING_TYPES = ('STRING', 'NUMERIC', 'BIGNUMERIC', 'DATETIME', 'TIME', 'TIMESTAMP', 'GEOGRAPHY', 'JSON')
+
+
+def record_converter(fields: list[dict]) -> dict:
+    # (repeated, nested converter or None, field type) per field name; shared by the parquet
+    # writer and bq_utils.StorageWriteSink, so both coerce records the same way
+    converter = {}
+
+    for field in fields:
+        field_type = field['type'].upper()
+        repeated = field.get('mode', 'NULLABLE').upper() == 'REPEATED'
+
+        if field_type in ('RECORD', 'STRUCT'):
+            converter[field['name']] = (repeated, record_converter(field['fields']), None)
+        else:
+            converter[field['name']] = (repeated, None, field_type)
+
+    return converter
+
+
+def convert_value(value, field_type: str):
+    # values are coerced like in BigQuery JSON loads, e.g. a number in a STRING column
+    if field_type in STRING_TYPES:
+        if not isinstance(value, str):
+            value = json.dumps(value)
+    elif isinstance(value, str):
+        if field_type == 'DATE':
+            value = datetime.date.fromisoformat(value)
+        elif field_type in ('INTEGER', 'INT64'):
+            value = int(value)
+        elif field_type in ('FLOAT', 'FLOAT64'):
+            value = float(value)
+        elif field_type in ('BOOLEAN', 'BOOL'):
+            value = value.lower() == 'true'
+    return value
+
+
+def convert_record(record: dict, converter: dict) -> dict:
+    # keeps the keys of the schema only; null values and empty lists are missing values
+    new = {}
+
+    for key, value in record.items():
+        field = converter.get(key)
+
+        if field is None or value is None or (isinstance(value, list) and not value):
+            continue
+
+        repeated, nested_converter, field_type = field
+
+        if repeated:
+            if not isinstance(value, list):
+                value = [value]
+            if nested_converter is not None:
+                value = [convert_record(v, nested_converter) for v in value if isinstance(v, dict)]
+            else:
+                value = [convert_value(v, field_type) for v in value if v is not None]
+
+        elif nested_converter is not None:
+            if not isinstance(value, dict):
+                continue
+            value = convert_record(value, nested_converter)
+
+        else:
+            value = convert_value(value, field_type)
+
+        new[key] = value
+
+    return new
+
+
+@functools.lru_cache(maxsize=8)
+def read_arrow_schema(schema_file_path: str, mtime: float) -> tuple:
+    with open(schema_file_path) as schema_file:
+        fields = json.load(schema_file)
+
+    return pyarrow.schema([arrow_field(field) for field in fields]), record_converter(fields)
+
+
+def load_arrow_schema(schema_file_path: str) -> tuple:
+    # the Arrow schema and record converter of a BigQuery schema file, cached until it changes
+    require_pyarrow()
+    schema_file_path = os.path.abspath(schema_file_path)
+    return read_arrow_schema(schema_file_path, os.path.getmtime(schema_file_path))
+
+
+def write_parquet(records,
+                  output_file_path: str,
+                  schema_file_path: str,
+                  row_group_size: int = 100000,
+                  compression: str = 'zstd') -> None:
+    # records are converted and written one row group at a time, so memory stays
+    # bounded by row_group_size records
+    schema, converter = load_arrow_schema(schema_file_path)
+
+    with pyarrow.parquet.ParquetWriter(output_file_path, schema, compression=compression) as writer:
+        rows = []
+
+        for record in records:
+            rows.append(convert_record(record, converter))
+
+            if len(rows) == row_group_size:
+                writer.write_table(pyarrow.Table.from_pylist(rows, schema=schema))
+                rows = []
+
+        if rows:
+            writer.write_table(pyarrow.Table.from_pylist(rows, schema=schema))
+
+
+def write_streams(records, output_file_path: str, sink) -> None:
+    # the records are appended to a pending stream of sink, e.g. a bq_utils.StorageWriteSink,
+    # and only become visible once the streams of all parts are committed together
+    stream_name = sink.write(records)
+
+    with open(output_file_path, 'w') as file:
+        json.dump([stream_name], file)
+
+
+def read_streams(transform_path: str) -> list[str]:
+    # the streams of all parts in the merged manifest of transform_path, to be committed at once
+    stream_names = []
+
+    for output in Manifest(os.path.join(transform_path, MANIFEST_NAME)).entries:
+        with open(output, 'r') as file:
+            stream_names.extend(json.load(file))
+
+    return stream_names
+
+
+def progress_file_path(file_path: str) -> str:
+    # hidden like the manifests and the snapshot marker, so that the transform never takes the
+    # progress of an interrupted download for an input
+    directory, filename = os.path.split(file_path)
+    return os.path.join(directory, f'.{filename}.progress')
+
+
+def download_ranged(url: str,
+                    file_path: str,
+                    headers: dict = None,
+                    connections: int = 8,
+                    chunk_size: int = 64 * 1024 * 1024,
+                    retries: int = 5) -> float:
+    # Downloads url with HTTP Range requests over several connections into a
+    # preallocated file. Completed chunks are recorded in a sidecar progress file,
+    # so an interrupted download resumes where it stopped. Returns the achieved
+    # throughput in bytes per second.
+    headers = headers or {}
+    start = time.perf_counter()
+
+    with requests.get(url, headers={**headers, 'Range': 'bytes=0-0'}, stream=True) as response:
+        response.raise_for_status()
+        content_range = response.headers.get('Content-Range', '')
+
+    if response.status_code != 206 or '/' not in content_range or content_range.endswith('/*'):
+        logging.info(f'{url} does not support range requests, downloading with a single connection.')
+        with requests.get(url, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            with open(file_path, 'wb') as file:
+                shutil.copyfileobj(RawReader(response.raw), file)
+        size = os.path.getsize(file_path)
+        return size / (time.perf_counter() - start)
+
+    size = int(content_range.rsplit('/', 1)[1])
+    chunks = [(offset, min(offset + chunk_size, size) - 1) for offset in range(0, size, chunk_size)]
+
+    progress_path = progress_file_path(file_path)
+    progress = dict(url=url, size=size, chunk_size=chunk_size, completed=[])
+
+    if os.path.exists(progress_path) and os.path.exists(file_path):
+        with open(progress_path, 'r') as file:
+            previous = json.load(file)
+        if (previous['url'], previous['size'], previous['chunk_size']) == (url, size, chunk_size) \
+                and os.path.getsize(file_path) == size:
+            progress = previous
+            logging.info(f'Resuming download of {url} with {len(progress["completed"])}/{len(chunks)} chunks done.')
+
+    if not progress['completed']:
+        with open(file_path, 'wb') as file:
+            file.truncate(size)
+
+    completed = set(progress['completed'])
+    downloaded = 0
+    sessions = threading.local()
+
+    def save_progress():
+        temp_path = progress_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(progress, file)
+        os.replace(temp_path, progress_path)
+
+    save_progress()
+
+    def download_chunk(fd, first_byte, last_byte):
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+
+        for attempt in range(retries + 1):
+            try:
+                chunk_headers = {**headers, 'Range': f'bytes={first_byte}-{last_byte}'}
+                with sessions.session.get(url, headers=chunk_headers, stream=True, timeout=60) as chunk_response:
+                    if chunk_response.status_code != 206:
+                        raise IOError(f'Unexpected status {chunk_response.status_code} for range '
+                                      f'{first_byte}-{last_byte} of {url}.')
+
+                    offset = first_byte
+                    reader = RawReader(chunk_response.raw)
+                    for data in iter(lambda: reader.read(1024 * 1024), b''):
+                        os.pwrite(fd, data, offset)
+                        offset += len(data)
+
+                if offset != last_byte + 1:
+                    raise IOError(f'Incomplete range {first_byte}-{last_byte} of {url}.')
+
+                return offset - first_byte
+
+            except (IOError, requests.RequestException) as error:
+                if attempt == retries:
+                    raise
+                logging.warning(f'Retrying range {first_byte}-{last_byte} of {url}: {error}')
+                time.sleep(min(2 ** attempt, 30))
+
+    fd = os.open(file_path, os.O_WRONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = {executor.submit(download_chunk, fd, first_byte, last_byte): index
+                       for index, (first_byte, last_byte) in enumerate(chunks)
+                       if index not in completed}
+
+            for future in as_completed(futures):
+                downloaded += future.result()
+                progress['completed'].append(futures[future])
+                os.fsync(fd)
+                save_progress()
+    finally:
+        os.close(fd)
+
+    os.remove(progress_path)
+
+    throughput = downloaded / (time.perf_counter() - start)
+
+    logging.info(f'Downloaded {downloaded} bytes of {url} with {connections} connections '
+                 f'at {throughput / 1024 ** 2:.1f} MiB/s.')
+
+    return throughput
+
+
+class RawReader:
+
+    # reads an urllib3 response without decoding a Content-Encoding, so archives
+    # are stored exactly as served
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def read(self, size: int = None) -> bytes:
+        if size is not None and size < 0:
+            size = None
+        return self.raw.read(size, decode_content=False)
+
+
+MANIFEST_NAME = '.manifest.jsonl'
+
+SNAPSHOT_MARKER_NAME = '.snapshot'
+
+
+def prepare_directory(path: str, snapshot_date, clean: bool = False) -> None:
+    # Downloads, outputs and manifests of an interrupted run of the same snapshot are kept
+    # for resuming it. The directory is only emptied for another snapshot date, if it was
+    # not created for a snapshot yet, or with clean.
+    marker_path = os.path.join(path, SNAPSHOT_MARKER_NAME)
+    snapshot_date = json.loads(json.dumps(snapshot_date))
+
+    if os.path.isdir(path):
+        previous = None
+        if os.path.exists(marker_path):
+            with open(marker_path, 'r') as file:
+                previous = json.load(file)
+
+        if clean or previous != {'snapshot_date': snapshot_date}:
+            logging.info(f'Removing {path} of snapshot {previous}.')
+            shutil.rmtree(path)
+
+    os.makedirs(path, exist_ok=True)
+
+    with open(marker_path, 'w') as file:
+        json.dump({'snapshot_date': snapshot_date}, file)
+
+TransformTask = namedtuple('TransformTask', ['input_file_path',
+                                             'output_file_path',
+                                             'shard_index',
+                                             'shard_count',
+                                             'size'])
+
+
+def array_task() -> tuple[int, int]:
+    # (index, count) of the current Slurm array task, (0, 1) outside of job arrays
+    count = int(os.environ.get('SLURM_ARRAY_TASK_COUNT', 1))
+    index = int(os.environ.get('SLURM_ARRAY_TASK_ID', 0)) - int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0))
+    return index, count
+
+
+def select_files(files: list[tuple[str, str]],
+                 shard_index: int = 0,
+                 shard_count: int = 1) -> list[tuple[str, str]]:
+    # Deterministic share of the files for one of shard_count array tasks. Files are
+    # assigned largest first to the least loaded shard, so every task computes the same
+    # split of the same directory and the shards end up with similar total sizes.
+    if shard_count == 1:
+        return files
+
+    loads = [0] * shard_count
+    selected = []
+
+    for input_file_path, output_file_path in sorted(files, key=lambda file: (-os.path.getsize(file[0]), file[0])):
+        shard = loads.index(min(loads))
+        loads[shard] += os.path.getsize(input_file_path)
+        if shard == shard_index:
+            selected.append((input_file_path, output_file_path))
+
+    return selected
+
+
+def manifest_name(shard_index: int = 0, shard_count: int = 1) -> str:
+    # array tasks on different nodes each append to their own manifest
+    if shard_count == 1:
+        return MANIFEST_NAME
+    return f'.manifest-{shard_index}.jsonl'
+
+
+def merge_manifests(transform_path: str, shard_count: int) -> int:
+    # Run once all array tasks completed: appends the manifests of the tasks to the
+    # manifest of the transform directory and returns the number of completed parts.
+    manifest = Manifest(os.path.join(transform_path, MANIFEST_NAME))
+
+    for shard_index in range(shard_count):
+        shard_manifest_path = os.path.join(transform_path, manifest_name(shard_index, shard_count))
+        if not os.path.exists(shard_manifest_path):
+            continue
+
+        for entry in Manifest(shard_manifest_path).entries.values():
+            manifest.add(entry['input'], entry['output'], entry['checksum'], entry['size'], entry['mtime'])
+
+        os.remove(shard_manifest_path)
+
+    missing = [output for output in manifest.entries if not os.path.exists(output)]
+    if missing:
+        raise FileNotFoundError(f'Transformed files are missing: {missing[:10]}')
+
+    return len(manifest.entries)
+
+
+def follow_manifests(transform_path: str,
+                     on_complete,
+                     is_done,
+                     interval: float = 5,
+                     timeout: float = None) -> set[str]:
+    # Calls on_complete for every output listed in the manifests of transform_path, also the
+    # ones of array tasks running on other nodes, as soon as it is added. Returns the outputs
+    # once is_done() is true and the manifests were read a last time, so outputs added before
+    # the transform ended are never missed. Raises TimeoutError if is_done() is still false
+    # after timeout seconds.
+    start = time.monotonic()
+    completed = set()
+
+    while True:
+        done = is_done()
+
+        for name in sorted(os.listdir(transform_path)):
+            if not (name.startswith('.manifest') and name.endswith('.jsonl')):
+                continue
+
+            # the finalize job may merge and remove a manifest while it is read
+            try:
+                outputs = list(Manifest(os.path.join(transform_path, name)).entries)
+            except FileNotFoundError:
+                continue
+
+            for output in outputs:
+                if output not in completed:
+                    completed.add(output)
+                    on_complete(output)
+
+        if done:
+            return completed
+
+        now = time.monotonic()
+        if timeout is not None and now - start >= timeout:
+            raise TimeoutError(f'The transform in {transform_path} did not end within {timeout} seconds.')
+
+        sleep = interval
+        if timeout is not None:
+            sleep = min(sleep, max(0.0, start + timeout - now))
+
+        time.sleep(sleep)
+
+
+def plan_transform_tasks(files: list[tuple[str, str]],
+                         split_size: int = None,
+                         max_shards: int = 1) -> list[TransformTask]:
+    # Files larger than split_size are split into record-strided shards. Tasks are
+    # ordered largest first (LPT), so huge parts do not start last and leave the
+    # workers idle at the end of the run.
+    tasks = []
+    for input_file_path, output_file_path in files:
+        size = os.path.getsize(input_file_path)
+
+        shard_count = 1
+        if split_size:
+            shard_count = max(1, min(max_shards, math.ceil(size / split_size)))
+
+        for shard_index in range(shard_count):
+            tasks.append(TransformTask(input_file_path, output_file_path, shard_index, shard_count, size))
+
+    tasks.sort(key=lambda task: task.size / task.shard_count, reverse=True)
+
+    return tasks
+
+
+def shard_file_path(output_file_path: str, shard_index: int) -> str:
+    directory, filename = os.path.split(output_file_path)
+    return os.path.join(directory, f'.{filename}.shard-{shard_index}')
+
+
+def temp_file_path(output_file_path: str) -> str:
+    # hidden, so that globs over the transform directory never pick it up
+    directory, filename = os.path.split(output_file_path)
+    return os.path.join(directory, f'.{filename}.tmp')
+
+
+def file_checksum(file_path: str) -> str:
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def merge_shards(output_file_path: str, shard_count: int) -> str:
+    if output_file_path.endswith('.parquet'):
+        merge_parquet_shards(output_file_path, shard_count)
+        return file_checksum(output_file_path)
+
+    if output_file_path.endswith(OUTPUT_EXTENSIONS['storage_write']):
+        merge_stream_shards(output_file_path, shard_count)
+        return file_checksum(output_file_path)
+
+    # concatenated gzip members are a valid gzip file
+    md5 = hashlib.md5()
+    temp_path = temp_file_path(output_file_path)
+
+    with open(temp_path, 'wb') as output_file:
+        for shard_index in range(shard_count):
+            with open(shard_file_path(output_file_path, shard_index), 'rb') as shard_file:
+                for chunk in iter(lambda: shard_file.read(1024 * 1024), b''):
+                    md5.update(chunk)
+                    output_file.write(chunk)
+
+    os.replace(temp_path, output_file_path)
+
+    for shard_index in range(shard_count):
+        os.remove(shard_file_path(output_file_path, shard_index))
+
+    return md5.hexdigest()
+
+
+def merge_parquet_shards(output_file_path: str, shard_count: int) -> None:
+    # parquet files can not be concatenated, the row groups of the shards are copied one by one
+    temp_path = temp_file_path(output_file_path)
+    shard_paths = [shard_file_path(output_file_path, shard_index) for shard_index in range(shard_count)]
+
+    schema = pyarrow.parquet.read_schema(shard_paths[0])
+
+    with pyarrow.parquet.ParquetWriter(temp_path, schema, compression='zstd') as writer:
+        for shard_path in shard_paths:
+            shard_file = pyarrow.parquet.ParquetFile(shard_path)
+            for row_group in range(shard_file.num_row_groups):
+                writer.write_table(shard_file.read_row_group(row_group))
+
+    os.replace(temp_path, output_file_path)
+
+    for shard_path in shard_paths:
+        os.remove(shard_path)
+
+
+def merge_stream_shards(output_file_path: str, shard_count: int) -> None:
+    # every shard was written to its own stream, the part lists all of them
+    temp_path = temp_file_path(output_file_path)
+    shard_paths = [shard_file_path(output_file_path, shard_index) for shard_index in range(shard_count)]
+
+    stream_names = []
+    for shard_path in shard_paths:
+        with open(shard_path, 'r') as shard_file:
+            stream_names.extend(json.load(shard_file))
+
+    with open(temp_path, 'w') as file:
+        json.dump(stream_names, file)
+
+    os.replace(temp_path, output_file_path)
+
+    for shard_path in shard_paths:
+        os.remove(shard_path)
+
+
+class Manifest:
+
+    # One JSON line per completed output part, holding the input size and mtime
+    # it was transformed from and the checksum of the output. Lines are appended
+    # and fsynced as parts finish, so the manifest survives a killed job.
+
+    def __init__(self, manifest_path: str):
+        self.manifest_path = manifest_path
+        self.entries = {}
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line of a job killed mid-write
+                        continue
+                    self.entries[entry['output']] = entry
+
+    def is_complete(self,
+                    input_file_path: str,
+                    output_file_path: str,
+                    size: int = None,
+                    mtime: float = None) -> bool:
+        # size and mtime are read from input_file_path unless given, e.g. for tar members
+        entry = self.entries.get(output_file_path)
+
+        if not entry or entry['input'] != input_file_path or not os.path.exists(output_file_path):
+            return False
+
+        if size is None:
+            if not os.path.exists(input_file_path):
+                return False
+            stat = os.stat(input_file_path)
+            size, mtime = stat.st_size, stat.st_mtime
+
+        if entry['size'] != size or entry['mtime'] != mtime:
+            return False
+
+        return entry['checksum'] == file_checksum(output_file_path)
+
+    def add(self,
+            input_file_path: str,
+            output_file_path: str,
+            checksum: str,
+            size: int = None,
+            mtime: float = None) -> None:
+
+        if size is None:
+            stat = os.stat(input_file_path)
+            size, mtime = stat.st_size, stat.st_mtime
+
+        entry = dict(input=input_file_path,
+                     output=output_file_path,
+                     size=size,
+                     mtime=mtime,
+                     checksum=checksum)
+
+        self.entries[output_file_path] = entry
+
+        with open(self.manifest_path, 'a') as file:
+            file.write(json.dumps(entry) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+    def clear(self) -> None:
+        self.entries = {}
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+
+
+def timed_call(func, *args) -> tuple[float, float]:
+    wall_time = time.perf_counter()
+    cpu_time = time.process_time()
+
+    func(*args)
+
+    return time.perf_counter() - wall_time, time.process_time() - cpu_time
+
+
+# snapshot of the current worker process, set once by init_worker so that tasks
+# only need to carry file paths
+worker_snapshot = None
+
+
+def init_worker(snapshot) -> None:
+    global worker_snapshot
+    worker_snapshot = snapshot
+
+
+def transform_task(input_file,
+                   output_file_path: str,
+                   shard_index: int = 0,
+                   shard_count: int = 1) -> tuple[float, float, str]:
+    # input_file is a path, or the raw bytes of a member streamed out of a tarball
+    if isinstance(input_file, bytes):
+        input_file = io.BytesIO(input_file)
+
+    # outputs are written under a temporary name and renamed once complete
+    temp_path = temp_file_path(output_file_path)
+
+    wall_time, cpu_time = timed_call(worker_snapshot.transform_file,
+                                     input_file,
+                                     temp_path,
+                                     shard_index,
+                                     shard_count)
+
+    os.replace(temp_path, output_file_path)
+
+    checksum = file_checksum(output_file_path) if shard_count == 1 else None
+
+    return wall_time, cpu_time, checksum
+
+
+def run_transform_tasks(snapshot,
+                        tasks: list[TransformTask],
+                        max_workers: int,
+                        manifest_path: str = None,
+                        resume: bool = False,
+                        on_complete=None) -> None:
+    # on_complete is called with the path of every finished output, e.g. PipelinedUploader.put
+    start = time.perf_counter()
+    total_cpu_time = 0.0
+
+    manifest = None
+    if manifest_path:
+        manifest = Manifest(manifest_path)
+        if not resume:
+            manifest.clear()
+
+    if manifest and resume:
+        completed = {task.output_file_path for task in tasks
+                     if manifest.is_complete(task.input_file_path, task.output_file_path)}
+        if completed:
+            logging.info(f'Skipping {len(completed)} files completed in a previous run.')
+        tasks = [task for task in tasks if task.output_file_path not in completed]
+
+    remaining_shards = Counter(task.output_file_path for task in tasks)
+
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             initializer=init_worker,
+                             initargs=(snapshot,)) as executor:
+        futures = {}
+
+        for task in tasks:
+            output_file_path = task.output_file_path
+            if task.shard_count > 1:
+                output_file_path = shard_file_path(output_file_path, task.shard_index)
+
+            future = executor.submit(transform_task,
+                                     task.input_file_path,
+                                     output_file_path,
+                                     task.shard_index,
+                                     task.shard_count)
+            futures[future] = task
+
+        for future in as_completed(futures):
+            task = futures[future]
+            wall_time, cpu_time, checksum = future.result()
+            total_cpu_time += cpu_time
+
+            logging.info(f'Transformed {task.input_file_path} '
+                         f'(shard {task.shard_index + 1}/{task.shard_count}, {task.size} bytes) '
+                         f'in {wall_time:.1f}s.')
+
+            remaining_shards[task.output_file_path] -= 1
+            if remaining_shards[task.output_file_path]:
+                continue
+
+            if task.shard_count > 1:
+                checksum = merge_shards(task.output_file_path, task.shard_count)
+
+            if manifest:
+                manifest.add(task.input_file_path, task.output_file_path, checksum)
+
+            if on_complete:
+                on_complete(task.output_file_path)
+
+    elapsed = time.perf_counter() - start
+    utilization = total_cpu_time / (elapsed * max_workers) if elapsed else 0.0
+
+    logging.info(f'Transformed {len(remaining_shards)} files in {len(tasks)} tasks in {elapsed:.1f}s, '
+                 f'core utilization {utilization:.0%} of {max_workers} workers.')
+
+
+def open_input(input_file):
+    # gzip-compressed or plain JSON, given as a path or a seekable binary file object
+    if isinstance(input_file, (str, os.PathLike)):
+        with open(input_file, 'rb') as file:
+            is_gzip = file.read(2) == b'\x1f\x8b'
+        return gzip.open(input_file, mode='rb') if is_gzip else open(input_file, 'rb')
+
+    is_gzip = input_file.read(2) == b'\x1f\x8b'
+    input_file.seek(0)
+
+    return gzip.GzipFile(fileobj=input_file, mode='rb') if is_gzip else input_file
+
+
+def tar_output_name(member_name: str, extension: str = '.jsonl.gz') -> str:
+    name = os.path.basename(member_name)
+
+    if name.endswith('.gz'):
+        name = name[:-3]
+
+    if name.endswith('.json'):
+        name = name[:-5]
+
+    return name + extension
+
+
+def run_tar_transform(snapshot,
+                      tar_file,
+                      tar_name: str,
+                      output_path: str,
+                      max_workers: int,
+                      manifest_path: str = None,
+                      resume: bool = False,
+                      shard_index: int = 0,
+                      shard_count: int = 1,
+                      on_complete=None) -> None:
+    # Members are read from the (possibly still downloading) tar stream one after
+    # another and handed to the workers as they arrive. At most 2 * max_workers
+    # members are held in memory at any time. Array tasks transform every
+    # shard_count-th member, the others are skipped without being extracted.
+    start = time.perf_counter()
+    total_cpu_time = 0.0
+    n_members = 0
+
+    manifest = None
+    if manifest_path:
+        manifest = Manifest(manifest_path)
+        if not resume:
+            manifest.clear()
+
+    def collect(done):
+        nonlocal total_cpu_time, n_members
+        for future in done:
+            member, output_file_path = futures.pop(future)
+            wall_time, cpu_time, checksum = future.result()
+            total_cpu_time += cpu_time
+            n_members += 1
+
+            logging.info(f'Transformed {tar_name}:{member.name} ({member.size} bytes) in {wall_time:.1f}s.')
+
+            if manifest:
+                manifest.add(f'{tar_name}:{member.name}', output_file_path, checksum, member.size, member.mtime)
+
+            if on_complete:
+                on_complete(output_file_path)
+
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             initializer=init_worker,
+                             initargs=(snapshot,)) as executor, \
+            tarfile.open(fileobj=tar_file, mode='r|*') as tar:
+
+        futures = {}
+
+        member_index = -1
+        member_names = {}
+
+        for member in tar:
+            if not member.isfile():
+                continue
+
+            output_file_path = os.path.join(output_path, tar_output_name(member.name, snapshot.output_extension))
+
+            # outputs are named after the basename of the member, checked for every member so
+            # that all array tasks fail alike
+            if output_file_path in member_names:
+                raise ValueError(f'Members {member_names[output_file_path]} and {member.name} of {tar_name} '
+                                 f'would both be written to {output_file_path}.')
+            member_names[output_file_path] = member.name
+
+            member_index += 1
+            if member_index % shard_count != shard_index:
+                continue
+
+            if manifest and resume and manifest.is_complete(f'{tar_name}:{member.name}',
+                                                            output_file_path,
+                                                            member.size,
+                                                            member.mtime):
+                logging.info(f'Skipping {tar_name}:{member.name} completed in a previous run.')
+                continue
+
+            # a member is only read once a slot is free, so the pending members and this one
+            # stay within 2 * max_workers
+            while len(futures) >= 2 * max_workers:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            data = tar.extractfile(member).read()
+
+            futures[executor.submit(transform_task, data, output_file_path)] = (member, output_file_path)
+
+        collect(as_completed(list(futures)))
+
+    elapsed = time.perf_counter() - start
+    utilization = total_cpu_time / (elapsed * max_workers) if elapsed else 0.0
+
+    logging.info(f'Transformed {n_members} members of {tar_name} in {elapsed:.1f}s, '
+                 f'core utilization {utilization:.0%} of {max_workers} workers.')